@@ -1,38 +1,681 @@
+from __future__ import annotations
+
+import io
 import os
+import re
 import json
+import gzip
+import time
+import random
+import glob
+import shutil
+import hashlib
+import asyncio
+import functools
+import warnings
+import xml.etree.ElementTree
 import tempfile
 import logging
+import threading
+import importlib
+import importlib.util
+import types
 import requests
+import requests.adapters
 import geojson
-import geopandas
-import pandas
-import duckdb
-import psutil
+import numpy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LazyModule(types.ModuleType):
+    ''' Stands in for a module and imports it on first attribute access, so importing
+        datatools and creating a downloader do not pay for the heavy backends
+        (geopandas, duckdb, pyarrow, ...) until a method uses them.
+    params:
+        name: module name
+        submodules: submodules imported with it, eg. ['parquet'] for pyarrow.parquet
+    usage:
+        geopandas = LazyModule('geopandas')
+    '''
+    def __init__(self, name, submodules=()) -> None:
+        super().__init__(name)
+        self.__dict__['_submodules'] = submodules
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        for submodule in self._submodules:
+            importlib.import_module(f'{self.__name__}.{submodule}')
+        # later lookups find the module attributes directly
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+geopandas = LazyModule('geopandas')
+pandas = LazyModule('pandas')
+duckdb = LazyModule('duckdb')
+psutil = LazyModule('psutil')
+pyarrow = LazyModule('pyarrow', submodules=['parquet', 'ipc'])
+shapely = LazyModule('shapely')
+
+# optional accelerators for decoding WFS responses
+try:
+    import orjson
+except ImportError:
+    orjson = None
+pyogrio = LazyModule('pyogrio') if importlib.util.find_spec('pyogrio') is not None else None
+
+DUCKDB_EXTENSION_DIR = os.environ.get('DUCKDB_EXTENSION_DIR')    #local extension repository for offline nodes
+# set DUCKDB_INSTALL_EXTENSIONS=1 on networked machines to download spatial when it is missing
+DUCKDB_INSTALL_EXTENSIONS = os.environ.get('DUCKDB_INSTALL_EXTENSIONS', '').lower() in ('1', 'true', 'yes')
+__duckdb_connection__ = None
+__duckdb_extension_dir__ = None
+__duckdb_lock__ = threading.Lock()
+__duckdb_cursors__ = threading.local()
+
+
+def duckdb_connection(extension_dir=None, install=None):
+    ''' Returns the calling thread's cursor on the in-memory DuckDB database shared by
+        every downloader in the process, so views registered by one thread are seen by
+        all of them. The database is created on first use with extension auto install
+        and auto load disabled, so by default nothing is fetched from the network. The
+        spatial extension is loaded from extension_dir (default DUCKDB_EXTENSION_DIR, or
+        DuckDB's own directory). With install it is downloaded there first when missing.
+        When it is not available a warning is logged and the ST_* functions
+        (register_parquet, sql_to_df) are not available.
+        Only the first call configures the database, later arguments are ignored.
+    params:
+        extension_dir: directory holding installed DuckDB extensions
+        install: download missing extensions from the DuckDB repository,
+            default DUCKDB_INSTALL_EXTENSIONS (off)
+    usage:
+        con = datatools.duckdb_connection('/opt/duckdb/extensions')
+        con = datatools.duckdb_connection(install=True)
+    '''
+    global __duckdb_connection__, __duckdb_extension_dir__
+    with __duckdb_lock__:
+        if __duckdb_connection__ is None:
+            extension_dir = extension_dir or DUCKDB_EXTENSION_DIR
+            install = DUCKDB_INSTALL_EXTENSIONS if install is None else install
+            config = {'autoinstall_known_extensions': False, 'autoload_known_extensions': False}
+            if extension_dir:
+                config['extension_directory'] = extension_dir
+            con = duckdb.connect(database=':memory:', config=config)
+            try:
+                con.load_extension('spatial')
+            except duckdb.Error as e:
+                if install:
+                    try:
+                        logging.info("Installing the DuckDB spatial extension")
+                        con.install_extension('spatial')
+                        con.load_extension('spatial')
+                        e = None
+                    except duckdb.Error as install_error:
+                        e = install_error
+                if e is not None:
+                    logging.warning(f"DuckDB spatial extension is not installed, ST_* functions are not available. "
+                                    f"Install it into {extension_dir or 'the DuckDB extension directory'}, "
+                                    f"set DUCKDB_EXTENSION_DIR or DUCKDB_INSTALL_EXTENSIONS=1: {e}")
+            __duckdb_connection__ = con
+            __duckdb_extension_dir__ = extension_dir
+        elif extension_dir and extension_dir != __duckdb_extension_dir__:
+            logging.warning(f"DuckDB is already open with extension directory "
+                            f"{__duckdb_extension_dir__ or 'the default'}, {extension_dir} is ignored")
+        # a DuckDB connection must not be used from several threads at once
+        if getattr(__duckdb_cursors__, 'database', None) is not __duckdb_connection__:
+            __duckdb_cursors__.database = __duckdb_connection__
+            __duckdb_cursors__.cursor = __duckdb_connection__.cursor()
+        return __duckdb_cursors__.cursor
 
 logger = logging.getLogger(__name__)
     
+
+class WFSError(Exception):
+    ''' Raised when a WFS request still fails after all retries'''
+
+
+class PageCheckpoint:
+    ''' On disk record of completed WFS pages for one query so an
+        interrupted download can resume where it stopped.
+        Pages are stored as gzipped json named by startIndex and the
+        directory is removed once the download completes.
+    params:
+        root: parent directory
+        key: query key, see DatasetCache.key
+    '''
+    def __init__(self, root, key) -> None:
+        self.path = os.path.join(root, f'wfs_checkpoint_{key[:16]}')
+        os.makedirs(self.path, exist_ok=True)
+
+    def page_path(self, start_index) -> str:
+        return os.path.join(self.path, f'page_{start_index:09d}.json.gz')
+
+    def has(self, start_index) -> bool:
+        return os.path.exists(self.page_path(start_index))
+
+    def load(self, start_index) -> bytes:
+        '''Returns the stored WFS response body'''
+        with gzip.open(self.page_path(start_index), 'rb') as f:
+            return f.read()
+
+    def save(self, start_index, content) -> None:
+        '''Stores a WFS response body'''
+        tmp = f'{self.page_path(start_index)}.{os.getpid()}.tmp'
+        with gzip.open(tmp, 'wb', compresslevel=1) as f:
+            f.write(content)
+        os.replace(tmp, self.page_path(start_index))
+
+    def cleanup(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class SpillCache:
+    ''' Spill directory for a single download.
+        Every download gets its own directory under root so concurrent
+        downloads on the same host never see each others chunk files.
+        Chunks are named chunk_00000.parquet, chunk_00001.parquet ... in write order
+        and the directory is removed by close (or on leaving a with block). Tables
+        from read_arrow memory map the chunks, close the cache only once they (and
+        any table sliced or filtered from them) are no longer used.
+    params:
+        root: parent directory, default tempfile.gettempdir()
+        prefix: directory name prefix, eg. the dataset name
+        max_bytes: optional cap on the total size of the chunk files
+        format: 'parquet' or 'arrow' (uncompressed Arrow IPC chunks that read_arrow
+            memory maps without copying)
+    usage:
+        with SpillCache(prefix='VRI_') as cache:
+            cache.write(df)
+            df = cache.read()
+    '''
+    def __init__(self, root=None, prefix='wfs_', max_bytes=None, format='parquet') -> None:
+        self.path = tempfile.mkdtemp(prefix=prefix, dir=root)
+        self.max_bytes = max_bytes
+        self.format = format
+        self.files = []
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def chunk_path(self, index) -> str:
+        '''Returns the file path for chunk number index'''
+        return os.path.join(self.path, f'chunk_{index:05d}.{"arrow" if self.format == "arrow" else "parquet"}')
+
+    def write(self, df) -> str:
+        '''Writes a GeoDataFrame (or pyarrow Table) as the next chunk, returns the chunk path'''
+        cache_file = self.chunk_path(len(self.files))
+        if self.format == 'arrow':
+            with pyarrow.ipc.new_file(cache_file, df.schema) as writer:
+                writer.write_table(df)
+        elif isinstance(df, pyarrow.Table):
+            pyarrow.parquet.write_table(df, cache_file)
+        else:
+            df.to_parquet(cache_file)
+        self.size += os.path.getsize(cache_file)
+        self.files.append(cache_file)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise IOError(f"Spill cache {self.path} exceeded {self.max_bytes} bytes ({self.size} bytes)")
+        return cache_file
+
+    def read(self) -> geopandas.GeoDataFrame:
+        '''Reads all chunks back, in write order, into one GeoDataFrame'''
+        geo_dfs = [geopandas.read_parquet(file_path) for file_path in self.files]
+        return geopandas.GeoDataFrame(pandas.concat(geo_dfs, ignore_index=True))
+
+    def read_arrow(self, memory_map=True) -> pyarrow.Table:
+        '''Returns all chunks, in write order, as one pyarrow Table.
+           With memory_map Arrow chunks are memory mapped so the table references
+           the spill files instead of copying them into memory.
+        '''
+        if self.format == 'arrow' and memory_map:
+            tables = [pyarrow.ipc.open_file(pyarrow.memory_map(file_path)).read_all() for file_path in self.files]
+        elif self.format == 'arrow':
+            tables = []
+            for file_path in self.files:
+                with pyarrow.OSFile(file_path) as f:
+                    tables.append(pyarrow.ipc.open_file(f).read_all())
+        else:
+            tables = [pyarrow.parquet.read_table(file_path, memory_map=memory_map) for file_path in self.files]
+        return pyarrow.concat_tables(tables, promote_options='permissive')
+
+    def close(self) -> None:
+        '''Deletes the spill directory and every chunk in it'''
+        try:
+            shutil.rmtree(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # eg. a chunk still memory mapped by a table on Windows
+            logging.warning(f"Could not remove spill cache {self.path}: {e}")
+        self.files.clear()
+        self.size = 0
+
+    cleanup = close
+
+
+class MemoryBudget:
+    ''' Keeps a download inside a process RSS budget.
+        The bytes each feature costs in memory are learned from the RSS growth
+        measured between pages (never less than the payload size) and the
+        remaining headroom under the budget decides the page size, how many rows
+        are held before spilling and how many pages may be in flight. Until the
+        first page is measured BYTES_PER_FEATURE is assumed, so the first request
+        is sized by the budget too. The figures are recomputed for every page so
+        a run adapts as memory fills up or frees.
+    params:
+        budget: RSS budget in bytes, default half of the physical memory
+        min_pagesize, max_pagesize: page size limits
+    usage:
+        wfs = WFS_downloader(memory_budget=6 * 1024**3)
+    '''
+    BYTES_PER_FEATURE = 16384    #assumed cost of a feature before any page is measured
+
+    def __init__(self, budget=None, min_pagesize=500, max_pagesize=10000) -> None:
+        self.__budget__ = budget
+        self.min_pagesize = min_pagesize
+        self.max_pagesize = max_pagesize
+        self.bytes_per_feature = None
+        self.__process__ = None
+        self.__last_rss__ = None
+
+    @property
+    def budget(self) -> int:
+        if self.__budget__ is None:
+            self.__budget__ = int(psutil.virtual_memory().total * 0.5)
+        return self.__budget__
+
+    @budget.setter
+    def budget(self, budget) -> None:
+        self.__budget__ = budget
+
+    @property
+    def process(self):
+        if self.__process__ is None:
+            self.__process__ = psutil.Process()
+        return self.__process__
+
+    def mark(self) -> None:
+        '''Records the RSS before a download, the first page is measured from here'''
+        self.__last_rss__ = self.rss()
+
+    def observe(self, features, payload_bytes) -> None:
+        '''Records a page of features and its payload size together with the RSS
+           growth since the last page. Pages that arrive after memory was freed
+           (eg. by a spill) do not show their cost and only move the baseline.
+        '''
+        rss = self.rss()
+        grown = rss - self.__last_rss__ if self.__last_rss__ is not None else 0
+        self.__last_rss__ = rss
+        if features <= 0 or grown <= 0:
+            return
+        observed = max(grown, payload_bytes) / features
+        if self.bytes_per_feature is None:
+            self.bytes_per_feature = observed
+        else:
+            self.bytes_per_feature = 0.7 * self.bytes_per_feature + 0.3 * observed
+
+    def rss(self) -> int:
+        return self.process.memory_info().rss
+
+    def headroom(self) -> int:
+        '''Returns bytes left under the budget'''
+        return max(self.budget - self.rss(), 0)
+
+    def feature_bytes(self) -> float:
+        '''Returns the measured bytes per feature, BYTES_PER_FEATURE before the first page'''
+        return self.bytes_per_feature or self.BYTES_PER_FEATURE
+
+    def pagesize(self, max_workers=1) -> int:
+        '''Returns a page size where every in flight page plus the spill buffer fits the headroom'''
+        pagesize = int(self.headroom() / (self.feature_bytes() * (max_workers + 2)))
+        return min(max(pagesize, self.min_pagesize), self.max_pagesize)
+
+    def workers(self, max_workers, pagesize) -> int:
+        '''Returns how many pages of pagesize may be in flight, at most max_workers'''
+        pages = int(self.headroom() / (self.feature_bytes() * pagesize)) - 2
+        return min(max(pages, 1), max_workers)
+
+    def spill_rows(self) -> int:
+        '''Returns the number of rows to hold in memory before spilling to disk'''
+        return max(int(self.headroom() * 0.25 / self.feature_bytes()), self.min_pagesize)
+
+
+class DownloadMetrics:
+    ''' Per page instrumentation of WFS downloads.
+        Every page records its request latency (until the body is read), bytes
+        received decoded and on the wire (None when the transport does not report
+        it), decode time, retries and features/sec, and the dataset progress gives
+        an ETA from numberMatched. Retries and spills to disk are recorded as events
+        too. Hooks receive every event as a dict as it happens and summary() adds the
+        time spent on the network and on the CPU (decode, GeoDataFrame conversion,
+        spilling) to tell a network bound run from a CPU bound one.
+    usage:
+        wfs = WFS_downloader()
+        wfs.metrics.add_hook(lambda event: print(event['event'], event.get('eta')))
+        df = wfs.get_data('WHSE_FOREST_VEGETATION.VEG_COMP_LYR_R1_POLY', bbox=bbox)
+        wfs.metrics.to_json('vri_metrics.json')
+    '''
+    def __init__(self) -> None:
+        self.hooks = []
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        '''Clears the recorded pages, events and timings, hooks are kept'''
+        with self.lock:
+            self.started = time.time()
+            self.datasets = {}
+            self.pages = []
+            self.events = []
+            self.timings = {'convert_seconds': 0.0}
+
+    def add_hook(self, hook) -> None:
+        '''Calls hook(event) for every page, retry, spill, start and finish event'''
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook) -> None:
+        self.hooks.remove(hook)
+
+    def emit(self, event) -> dict:
+        '''Records an event and passes it to the hooks, hook errors are logged and ignored'''
+        event.setdefault('time', time.time())
+        with self.lock:
+            if event['event'] == 'page':
+                self.pages.append(event)
+            else:
+                self.events.append(event)
+        for hook in list(self.hooks):
+            try:
+                hook(event)
+            except Exception as e:
+                logging.warning(f"Download metrics hook {hook} failed: {e}")
+        return event
+
+    def begin(self, dataset) -> None:
+        '''Starts the progress of a download of dataset. Downloads of the same dataset that
+           overlap (eg. AOI tiles) add up, one that begins after the others finished starts over.
+        '''
+        with self.lock:
+            progress = self.datasets.get(dataset)
+            new = progress is None or progress['active'] == 0
+            if new:
+                progress = self.datasets[dataset] = {'matched': 0, 'returned': 0, 'pages': 0, 'active': 0,
+                                                     'started': time.time(), 'finished': None}
+            progress['active'] += 1
+        if new:
+            self.emit({'event': 'start', 'dataset': dataset})
+
+    def matched(self, dataset, matched) -> None:
+        with self.lock:
+            self.datasets[dataset]['matched'] += matched
+
+    def page(self, dataset, page, rss=None) -> dict:
+        '''Records a decoded WFS page, returns the page event'''
+        stats = page.get('stats') or {}
+        features = int(page.get('numberReturned') or 0)
+        with self.lock:
+            progress = self.datasets[dataset]
+            progress['returned'] += features
+            progress['pages'] += 1
+            returned, matched = progress['returned'], progress['matched']
+            elapsed = time.time() - progress['started']
+        busy = stats.get('latency', 0.0) + stats.get('decode_seconds', 0.0)
+        rate = returned / elapsed if elapsed > 0 else None
+        return self.emit({'event': 'page', 'dataset': dataset,
+                          'start_index': stats.get('start_index'),
+                          'features': features,
+                          'latency': stats.get('latency'),
+                          'bytes': page.get('bytes'),
+                          'wire_bytes': stats.get('wire_bytes'),
+                          'decode_seconds': stats.get('decode_seconds'),
+                          'retries': stats.get('retries', 0),
+                          'checkpoint': 'stats' not in page,
+                          'features_per_sec': features / busy if busy > 0 else None,
+                          'returned': returned, 'matched': matched,
+                          'eta': (matched - returned) / rate if rate and matched >= returned else None,
+                          'rss': rss})
+
+    def finish(self, dataset) -> None:
+        with self.lock:
+            progress = self.datasets[dataset]
+            progress['active'] -= 1
+            finished = progress['active'] == 0
+            if finished:
+                progress['finished'] = time.time()
+        if finished:
+            self.emit({'event': 'finish', 'dataset': dataset})
+
+    def add_time(self, name, seconds) -> None:
+        with self.lock:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def summary(self) -> dict:
+        '''Returns totals for everything recorded since the last reset'''
+        with self.lock:
+            pages = list(self.pages)
+            events = list(self.events)
+            datasets = {name: dict(progress) for name, progress in self.datasets.items()}
+            timings = dict(self.timings)
+        total = lambda key, items=pages: sum(item.get(key) or 0 for item in items)
+        spills = [e for e in events if e['event'] == 'spill']
+        wall = max([p['finished'] or time.time() for p in datasets.values()] or [time.time()]) - self.started
+        cpu = total('decode_seconds') + timings['convert_seconds'] + total('seconds', spills)
+        for progress in datasets.values():
+            progress['seconds'] = (progress['finished'] or time.time()) - progress['started']
+        return {'datasets': datasets,
+                'pages': len(pages),
+                'features': total('features'),
+                'bytes': total('bytes'),
+                'wire_bytes': total('wire_bytes'),
+                'wire_bytes_unknown': sum(1 for p in pages if p.get('wire_bytes') is None and not p['checkpoint']),
+                'retries': sum(1 for e in events if e['event'] == 'retry'),
+                'spills': len(spills),
+                'spill_bytes': total('bytes', spills),
+                'wall_seconds': wall,
+                'request_seconds': total('latency'),
+                'decode_seconds': total('decode_seconds'),
+                'convert_seconds': timings['convert_seconds'],
+                'spill_seconds': total('seconds', spills),
+                'features_per_sec': total('features') / wall if wall > 0 else None,
+                'peak_rss': max([p['rss'] or 0 for p in pages] or [0]),
+                # request time is summed over concurrent requests, compare it with the cpu time of the same pages
+                'bound': 'network' if total('latency') > cpu else 'cpu',
+                'page_log': pages,
+                'events': events}
+
+    def to_json(self, path=None) -> str:
+        '''Returns the summary as json, written to path when given'''
+        text = json.dumps(self.summary(), indent=2, default=str)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+
+class DatasetCache:
+    ''' Persistent content addressed cache of downloaded datasets.
+        Each entry is a GeoParquet file named by the sha256 of the normalized
+        query parameters with a small json sidecar recording the parameters,
+        creation time and last access time.
+    params:
+        path: cache directory, created if missing
+        ttl: seconds an entry stays valid, None never expires
+        max_bytes: byte budget, least recently used entries are evicted past it
+    usage:
+        wfs = WFS_downloader(dataset_cache=DatasetCache('~/.uwr_cache', ttl=7*24*3600, max_bytes=20*1024**3))
+        df = wfs.get_data('WHSE_WILDLIFE_MANAGEMENT.WCP_UNGULATE_WINTER_RANGE_SP')
+        df = wfs.get_data('WHSE_WILDLIFE_MANAGEMENT.WCP_UNGULATE_WINTER_RANGE_SP', refresh=True)
+    '''
+    def __init__(self, path, ttl=None, max_bytes=None) -> None:
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def params(service_url, dataset, query=None, fields=None, bbox=None, **options) -> dict:
+        '''Returns the normalized wfs_query parameters used for the cache key.
+           Extra download options (eg. aoi, tile_size) are added when not None,
+           geometries are reduced to a digest of their WKB.
+        '''
+        params = {'service': service_url,
+                  'dataset': dataset,
+                  'query': ' '.join(query.split()) if query else None,
+                  'bbox': [str(b) for b in bbox] if bbox is not None else None,
+                  'fields': sorted(f.upper() for f in fields) if fields else None}
+        for name, value in options.items():
+            if isinstance(value, shapely.Geometry):
+                value = hashlib.sha256(value.wkb).hexdigest()
+            if value is not None:
+                params[name] = value
+        return params
+
+    @staticmethod
+    def key(params) -> str:
+        '''Returns the cache key for normalized parameters'''
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def data_path(self, key) -> str:
+        return os.path.join(self.path, f'{key}.parquet')
+
+    def __meta_path__(self, key) -> str:
+        return os.path.join(self.path, f'{key}.json')
+
+    def __read_meta__(self, key):
+        try:
+            with open(self.__meta_path__(key), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def __write_meta__(self, key, meta) -> None:
+        tmp = f'{self.__meta_path__(key)}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.__meta_path__(key))
+
+    def get(self, key):
+        '''Returns the GeoParquet path for key or None when missing or expired'''
+        meta = self.__read_meta__(key)
+        if meta is None or not os.path.exists(self.data_path(key)):
+            return None
+        if self.ttl is not None and time.time() - meta['created'] > self.ttl:
+            logging.info(f'Dataset cache entry {key} expired')
+            self.remove(key)
+            return None
+        meta['accessed'] = time.time()
+        self.__write_meta__(key, meta)
+        return self.data_path(key)
+
+    def put(self, key, df, params=None) -> str:
+        '''Stores a GeoDataFrame under key, returns the cached file path'''
+        tmp = f'{self.data_path(key)}.{os.getpid()}.tmp'
+        df.to_parquet(tmp)
+        return self.__commit__(key, tmp, params)
+
+    def put_table(self, key, table, params=None) -> str:
+        '''Stores a pyarrow Table (with GeoParquet metadata) under key'''
+        tmp = f'{self.data_path(key)}.{os.getpid()}.tmp'
+        pyarrow.parquet.write_table(table, tmp)
+        return self.__commit__(key, tmp, params)
+
+    def put_file(self, key, parquet_file, params=None) -> str:
+        '''Stores a copy of an existing GeoParquet file under key'''
+        tmp = f'{self.data_path(key)}.{os.getpid()}.tmp'
+        shutil.copyfile(parquet_file, tmp)
+        return self.__commit__(key, tmp, params)
+
+    def __commit__(self, key, tmp, params) -> str:
+        os.replace(tmp, self.data_path(key))
+        now = time.time()
+        self.__write_meta__(key, {'params': params, 'created': now, 'accessed': now,
+                                  'size': os.path.getsize(self.data_path(key))})
+        self.evict(keep=key)
+        return self.data_path(key)
+
+    def remove(self, key) -> None:
+        for file_path in (self.data_path(key), self.__meta_path__(key)):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def evict(self, keep=None) -> None:
+        '''Removes least recently used entries until the cache fits max_bytes.
+           The keep entry (the one just stored) is never removed, an entry larger than
+           max_bytes stays until the next one is stored.
+        '''
+        if self.max_bytes is None:
+            return
+        entries = []
+        total = 0
+        for file in os.listdir(self.path):
+            if file.endswith('.json'):
+                key = file[:-len('.json')]
+                meta = self.__read_meta__(key)
+                if meta is None:
+                    continue
+                total += meta['size']
+                if key != keep:
+                    entries.append((meta['accessed'], meta['size'], key))
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logging.info(f'Evicting dataset cache entry {key} ({size} bytes)')
+            self.remove(key)
+            total -= size
+
+    def clear(self) -> None:
+        '''Removes every cache entry'''
+        for file in os.listdir(self.path):
+            if file.endswith(('.parquet', '.json')):
+                os.remove(os.path.join(self.path, file))
+
  
 class WFS_downloader:
     ''' Downloads data from WFS
     '''
     SERVICE_URL = "https://openmaps.gov.bc.ca/geo/pub/ows?"
     PAGESIZE = 10000
+    MAX_WORKERS = 1
+    TILE_SIZE = 20000    #tile edge length in EPSG:3005 metres for aoi downloads
+    AOI_CRS = "EPSG:3005"
+    GEOMETRY_FIELD = "GEOMETRY"
+    MAX_FILTER_LENGTH = 20000    #max characters of AOI WKT sent in a CQL filter
+    MAX_URL_LENGTH = 6000    #longer requests are sent as a POST body
+    TIMEOUT = (10, 300)    #(connect, read) seconds for every WFS request
+    POOL_SIZE = 16    #max kept alive connections to the WFS host
+    FAST_DECODE = False    #decode pages with pyogrio straight to columns, see decode_page
+    OUTPUT_FORMAT = 'json'    #WFS outputFormat, 'auto' picks the first of PREFERRED_FORMATS the service offers
+    # compact lossless formats in order of preference, read with pyogrio
+    PREFERRED_FORMATS = ['application/flatgeobuf', 'flatgeobuf',
+                         'application/geopackage+sqlite3', 'application/x-gpkg', 'geopackage', 'gpkg']
     # http://openmaps.gov.bc.ca/geo/pub/wfs?request=GetCapabilities
     # https://openmaps.gov.bc.ca/geo/pub/WHSE_FOREST_VEGETATION.VEG_COMP_LYR_R1_POLY/wfs?request=GetCapabilities
 
 
-    def __init__(self) -> None:
-        self.MEMORY_THRESHOLD =600000000    #memory threshold in bytes
-        self.MEMORY_RATE = 0
+    def __init__(self, dataset_cache=None, memory_budget=None) -> None:
+        self.dataset_cache = dataset_cache    #optional DatasetCache
+        self.memory = MemoryBudget(memory_budget, max_pagesize=self.PAGESIZE)
+        self.metrics = DownloadMetrics()    #per page instrumentation, see DownloadMetrics
         self.CACHE_FILES = []
         self.CACHE_DIR = tempfile.gettempdir()
+        self.CACHE_MAX_BYTES = None      #spill cache size cap in bytes, None is unlimited
+        self.cache = None
         self.MAX_RETRIES = 5
+        self.BACKOFF = 1.0    #first retry delay in seconds, doubled each attempt
+        self.BACKOFF_MAX = 60.0
         self.OFFSET=0
-        self.con = duckdb.connect(database=':memory:')
-        self.con.install_extension("httpfs")
-        self.con.load_extension("httpfs")
-        self.con.execute("INSTALL spatial;")
-        self.con.execute("LOAD spatial;")
+        self.output_formats = {}    #capabilities url: outputFormat values from GetCapabilities
+        self.resolved_output_formats = {}    #dataset: outputFormat sent with its GetFeature requests
+        # one keep-alive session for every page so TCP/TLS handshakes are paid once per connection
+        self.session = requests.Session()
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         self.data_geom_column = None
         self.data_crs = None
         
@@ -51,122 +694,814 @@ class WFS_downloader:
         bbox=tuple(bbox)
         logging.info(f"Bounding box coords: {bbox}")
         return bbox
+
+    def aoi_geometry(self, aoi):
+        ''' Returns an AOI as a single dissolved shapely geometry in EPSG:3005
+        params:
+            aoi: GeoDataFrame, file readable by geopandas or shapely geometry (assumed EPSG:3005)
+        '''
+        if isinstance(aoi, shapely.Geometry):
+            return aoi
+        if not isinstance(aoi, geopandas.GeoDataFrame):
+            df=geopandas.read_file(aoi)
+        else:
+            df=aoi
+        if df.crs is not None:
+            df = df.to_crs(self.AOI_CRS)
+        return df.geometry.union_all()
+
+    def plan_tiles(self, aoi, tile_size=None):
+        ''' Splits an AOI into a grid of bounding boxes, dropping tiles that
+            do not intersect the AOI geometry
+        params:
+            aoi: see aoi_geometry
+            tile_size: tile edge length in metres, default TILE_SIZE, 0 returns the AOI bbox
+        returns: list of bbox tuples in the create_bbox format
+        usage:
+            tiles = wfs.plan_tiles(uwr_df, tile_size=10000)
+        '''
+        if tile_size is None:
+            tile_size = self.TILE_SIZE
+        geom = self.aoi_geometry(aoi)
+        shapely.prepare(geom)
+        minx, miny, maxx, maxy = geom.bounds
+        if not tile_size:
+            return [tuple(int(v) for v in (numpy.floor(minx), numpy.floor(miny), numpy.ceil(maxx), numpy.ceil(maxy)))
+                    + ("urn:ogc:def:crs:EPSG:3005",)]
+        tiles = []
+        skipped = 0
+        for y in numpy.arange(numpy.floor(miny), maxy, tile_size):
+            for x in numpy.arange(numpy.floor(minx), maxx, tile_size):
+                tile = (int(x), int(y), int(numpy.ceil(min(x + tile_size, maxx))),
+                        int(numpy.ceil(min(y + tile_size, maxy))))
+                if geom.intersects(shapely.box(*tile)):
+                    tiles.append(tile + ("urn:ogc:def:crs:EPSG:3005",))
+                else:
+                    skipped += 1
+        logging.info(f"Planned {len(tiles)} tiles, skipped {skipped} outside the AOI")
+        return tiles
+
+    def aoi_filter(self, aoi, max_length=None) -> str:
+        ''' Returns the smallest CQL INTERSECTS filter that still selects every
+            feature intersecting the AOI.
+            The exact AOI WKT is used when it fits in max_length characters, otherwise
+            the AOI is buffered and simplified with growing tolerance (the result always
+            contains the AOI) and finally replaced by its convex hull.
+            Features selected by a generalized filter are dropped again by the
+            exact client side check in get_data.
+        params:
+            aoi: see aoi_geometry
+            max_length: max WKT characters, default MAX_FILTER_LENGTH
+        usage:
+            wfs.aoi_filter(tsa_df) -> "INTERSECTS(GEOMETRY, POLYGON ((...)))"
+        '''
+        if max_length is None:
+            max_length = self.MAX_FILTER_LENGTH
+        geom = self.aoi_geometry(aoi)
+        wkt = shapely.to_wkt(geom, trim=True)
+        if len(wkt) > max_length:
+            minx, miny, maxx, maxy = geom.bounds
+            tolerance = 1.0
+            while len(wkt) > max_length and tolerance < max(maxx - minx, maxy - miny):
+                # buffer past the tolerance (and integer rounding) so the simplified
+                # shape never cuts into the AOI
+                candidate = geom.buffer(tolerance + 1).simplify(tolerance, preserve_topology=True)
+                wkt = shapely.to_wkt(candidate, rounding_precision=0)
+                logging.debug(f"AOI filter tolerance {tolerance}m, {len(wkt)} characters")
+                tolerance *= 4
+            if len(wkt) > max_length:
+                wkt = shapely.to_wkt(geom.buffer(1).convex_hull, rounding_precision=0)
+            logging.info(f"AOI filter generalized to {len(wkt)} characters")
+        return f"INTERSECTS({self.GEOMETRY_FIELD}, {wkt})"
         
-    def adjust_pagesize_by_memory(self, current_pagesize, available_memory):
-        '''Funtion to adjust page size by available memory at time function is called'''
+    def adjust_pagesize_by_memory(self, current_pagesize, available_memory=None):
+        '''Funtion to adjust page size by the memory budget at time function is called
+           (see MemoryBudget), available_memory is no longer used'''
         
-        #in bytes
-        if available_memory < self.MEMORY_THRESHOLD:
-            adjusted_pagesize=max(current_pagesize // 2, 1)
-            logging.info(f"Adjusting pagesize to {adjusted_pagesize} due to low memory.")
-            return adjusted_pagesize
-        else:
-            return 10000
+        pagesize = min(self.memory.pagesize(), current_pagesize)
+        if pagesize != current_pagesize:
+            logging.info(f"Adjusting pagesize to {pagesize} for the memory budget.")
+        return pagesize
     
-    def __data_cache__(self,features):
-        ''' Cache data for large downloads'''
+    def __data_cache__(self,df):
+        ''' Cache data (GeoDataFrame) for large downloads'''
         
-        if len(features) >0:
+        if len(df) >0:
             dump_count = len(self.CACHE_FILES)
-            cache_file = os.path.join(self.CACHE_DIR,f'cache_{str(dump_count)}.parquet')
-            fc = geojson.FeatureCollection(features=features)
-            df = geopandas.GeoDataFrame.from_features(fc['features'])
-            df.to_parquet(cache_file)
-            self.CACHE_FILES.append(cache_file)
+            start = time.perf_counter()
+            cache_file = self.cache.write(self.__df_to_arrow__(df) if self.cache.format == 'arrow' else df)
+            self.metrics.emit({'event': 'spill', 'rows': len(df), 'bytes': os.path.getsize(cache_file),
+                               'seconds': time.perf_counter() - start, 'file': cache_file})
             logging.debug(f"chache file list {self.CACHE_FILES}")
             logging.debug(f'Cached features: {cache_file}')
             self.OFFSET = dump_count
-            all_features=[]
             return True
             
     def __load_cache_to_dataframe__(self) -> geopandas.GeoDataFrame:
         '''Load all cache data and merge into one GeoParquet'''
      
         logging.info('Loading cache to GeoDataFrame')
-        parquet_files = [file for file in os.listdir(self.CACHE_DIR) if file.endswith('.parquet')]
-        if not parquet_files:
+        if not self.CACHE_FILES:
             logging.warning('No Parquet files found in the cache directory.')
             return geopandas.GeoDataFrame()
     
-        geo_dfs = []
-        for parquet_file in parquet_files:
-            file_path = os.path.join(self.CACHE_DIR, parquet_file)
-            geo_df = geopandas.read_parquet(file_path)
-            geo_dfs.append(geo_df)
-    
-        concatenated_gdf = geopandas.GeoDataFrame(pandas.concat(geo_dfs, ignore_index=True))
+        # cache files are written in page order so reading them back in
+        # the same order keeps the OBJECTID sort from the WFS
+        concatenated_gdf = self.cache.read()
     
         if self.data_crs is not None:
-            concatenated_gdf.crs = self.data_crs
+            concatenated_gdf = concatenated_gdf.set_crs(self.data_crs, allow_override=True)
     
         return concatenated_gdf
+
+    @property
+    def con(self):
+        '''This thread's cursor on the process wide DuckDB database (see duckdb_connection)'''
+        return duckdb_connection()
+
+    def plan_pages(self, start_index, matched, pagesize):
+        '''Returns list of (start_index, count) windows covering the
+           features from start_index up to matched
+        params:
+            start_index: first feature index not yet downloaded
+            matched: numberMatched from the first WFS response
+            pagesize: features per request
+        usage:
+            wfs.plan_pages(10000, 25000, 10000) -> [(10000, 10000), (20000, 5000)]
+        '''
+        return [(i, min(pagesize, matched - i)) for i in range(start_index, matched, pagesize)]
+
+    def __fetch_page__(self, dataset, start_index, count=None, query=None, fields=None, bbox=None,
+                       checkpoint=None) -> dict:
+        '''Returns one WFS page, from the checkpoint when it was already downloaded'''
+        if checkpoint is not None and checkpoint.has(start_index):
+            logging.debug(f"Resuming page {start_index} from checkpoint")
+            return self.decode_page(checkpoint.load(start_index), self.output_format(dataset))
+        page = self.wfs_query(dataset=dataset, query=query, fields=fields, bbox=bbox,
+                              start_index=start_index, count=count)
+        if checkpoint is not None:
+            # stats describe this request, a resumed page is recorded without them
+            stored = {key: value for key, value in page.items() if key != 'stats'}
+            checkpoint.save(start_index, page.get('content') or json.dumps(stored).encode('utf-8'))
+        return page
+
+    def __fetch_window__(self, dataset, start_index, count, query=None, fields=None, bbox=None,
+                         checkpoint=None) -> list:
+        '''Returns the pages covering one planned (start_index, count) window.
+           A server that caps the page size below count returns a short page, the
+           rest of the window is then requested from where that page stopped.
+           Raises WFSError when a page comes back empty before the window is covered.
+        '''
+        pages = []
+        end = start_index + count
+        while start_index < end:
+            page = self.__fetch_page__(dataset, start_index, count=end - start_index, query=query,
+                                       fields=fields, bbox=bbox, checkpoint=checkpoint)
+            returned = int(page.get('numberReturned'))
+            if returned == 0:
+                raise WFSError(f"{dataset}: no features returned at startIndex {start_index}, "
+                               f"expected {end - start_index} more")
+            if returned < end - start_index:
+                logging.debug(f"Short page at {start_index}: {returned} of {end - start_index} features")
+            pages.append(page)
+            start_index += returned
+        return pages
+
+    def __iter_pages__(self, dataset, start_index, matched, query=None, fields=None, bbox=None,
+                       max_workers=1, checkpoint=None):
+        '''Yields WFS page responses in startIndex order
+
+        With max_workers > 1 (or a checkpoint, which needs repeatable windows) every
+        window is planned up front from numberMatched and fetched over a bounded
+        thread pool. At most max_workers pages are in flight (or waiting to be
+        consumed) at any time.
+        '''
+        if max_workers <= 1 and checkpoint is None:
+            while start_index < matched:
+                pagesize = self.adjust_pagesize_by_memory(self.PAGESIZE)
+                logging.debug(f'page is {pagesize}')
+                page = self.wfs_query(dataset=dataset, query=query, fields=fields, bbox=bbox,
+                                      start_index=start_index, count=pagesize)
+                if int(page.get('numberReturned')) == 0:
+                    raise WFSError(f"{dataset}: no features returned at startIndex {start_index}, "
+                                   f"numberMatched is {matched}")
+                start_index += int(page.get('numberReturned'))
+                yield page
+            return
+
+        max_workers = max(max_workers, 1)
+        if checkpoint is not None:
+            windows = iter(self.plan_pages(start_index, matched, self.PAGESIZE))
+        else:
+            windows = self.__budget_windows__(start_index, matched, max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            pending = deque()
+
+            def submit_next():
+                window = next(windows, None)
+                if window is not None:
+                    pending.append(pool.submit(self.__fetch_window__, dataset, window[0], window[1],
+                                               query=query, fields=fields, bbox=bbox,
+                                               checkpoint=checkpoint))
+
+            def fill():
+                # the budget may allow fewer pages in flight than there are workers
+                in_flight = self.memory.workers(max_workers, self.memory.pagesize(max_workers))
+                while len(pending) < in_flight:
+                    before = len(pending)
+                    submit_next()
+                    if len(pending) == before:
+                        break
+
+            fill()
+            try:
+                while pending:
+                    pages = pending.popleft().result()
+                    fill()
+                    yield from pages
+            finally:
+                for future in pending:
+                    future.cancel()
      
-    def get_data(self, dataset, query=None, fields=None, bbox=None):
+    def __budget_windows__(self, start_index, matched, max_workers):
+        '''Yields contiguous (start_index, count) windows sized by the memory budget when requested'''
+        while start_index < matched:
+            count = min(self.memory.pagesize(max_workers), self.PAGESIZE, matched - start_index)
+            yield start_index, count
+            start_index += count
+
+    def __iter_responses__(self, dataset, query=None, fields=None, bbox=None, max_workers=1, resume=False):
+        '''Yields every WFS response for a dataset, starting with the first page.
+           With resume every page is checkpointed to disk under CACHE_DIR and pages
+           already there from an earlier failed run are not downloaded again.
+        '''
+        checkpoint = None
+        if resume:
+            params = DatasetCache.params(self.SERVICE_URL, dataset, query=query, fields=fields, bbox=bbox,
+                                         pagesize=self.PAGESIZE, output_format=self.output_format(dataset))
+            checkpoint = PageCheckpoint(self.CACHE_DIR, DatasetCache.key(params))
+            logging.info(f"Checkpointing pages to {checkpoint.path}")
+        
+        self.metrics.begin(dataset)
+        try:
+            self.memory.mark()
+            r = self.__fetch_page__(dataset, 0, count=self.adjust_pagesize_by_memory(self.PAGESIZE), query=query,
+                                    fields=fields, bbox=bbox, checkpoint=checkpoint)
+            if r.get('numberMatched') is None:
+                # binary output formats carry no paging members
+                r['numberMatched'] = self.wfs_query(dataset=dataset, query=query, fields=fields, bbox=bbox, hits=True)
+            matched, returned = self.__first_page__(r, dataset)
+            yield r
+        
+            for current_features in self.__iter_pages__(dataset, returned, matched, query=query,
+                                                        fields=fields, bbox=bbox,
+                                                        max_workers=max_workers, checkpoint=checkpoint):
+                returned += int(current_features.get('numberReturned'))
+                self.memory.observe(int(current_features.get('numberReturned')), current_features.get('bytes', 0))
+                self.__page_metrics__(dataset, current_features)
+                yield current_features
+            if checkpoint is not None:
+                checkpoint.cleanup()
+        finally:
+            # a failed or abandoned download ends too, so the next one starts its own progress
+            self.metrics.finish(dataset)
+
+    def __page_metrics__(self, dataset, page) -> None:
+        '''Records a page in metrics and logs the progress'''
+        event = self.metrics.page(dataset, page, rss=self.memory.rss())
+        eta = f", ETA {event['eta']:.0f}s" if event['eta'] is not None else ""
+        logging.info(f"total returned features {event['returned']} of {event['matched']}{eta}")
+     
+    def __first_page__(self, r, dataset) -> tuple:
+        '''Reads crs and geometry column from the first page of a dataset, returns (matched, returned)'''
+        matched = int(r.get('numberMatched'))
+        returned = int(r.get('numberReturned'))
+        self.memory.observe(returned, r.get('bytes', 0))
+        logging.debug(f"matched features {matched}")
+        self.metrics.matched(dataset, matched)
+        self.__page_metrics__(dataset, r)
+        if self.data_crs is None:
+            self.data_crs = self.page_crs(r)
+        features = r.get('features') or []
+        if self.data_geom_column is None and r.get('geometry_name'):
+            self.data_geom_column = r['geometry_name'].lower()
+        elif self.data_geom_column is None and len(features) > 0 and 'geometry_name' in features[0]:
+            self.data_geom_column = features[0]['geometry_name'].lower()
+        return matched, returned
+
+    def page_crs(self, page):
+        '''Returns the crs of a decoded WFS page (eg. EPSG:3005), None when it has none'''
+        if 'crs' not in page:
+            return None
+        return page['crs']['properties']['name'].split('crs:')[1].replace('::', ':')
+
+    def __cache_lookup__(self, dataset, query, fields, bbox, refresh, **options):
+        '''Returns (key, params, cached path) for the dataset cache, all None when disabled'''
+        if self.dataset_cache is None:
+            return None, None, None
+        params = self.dataset_cache.params(self.SERVICE_URL, dataset, query=query, fields=fields, bbox=bbox,
+                                           **options)
+        key = self.dataset_cache.key(params)
+        cached = None if refresh else self.dataset_cache.get(key)
+        if cached is not None:
+            logging.info(f'Loading {dataset} from dataset cache {cached}')
+        return key, params, cached
+
+    def get_data(self, dataset, query=None, fields=None, bbox=None, max_workers=None, refresh=False,
+                 aoi=None, tile_size=None, resume=False, result='geopandas', spill_cache=None):
         '''Returns dataset in json format
         params:
             query: CQL formated query
             fields: comma deliminated str
             bbox: comma delimited float values in EPSG:3005 metres
+            max_workers: number of pages fetched concurrently, default MAX_WORKERS.
+                Values above 1 plan all startIndex/count windows from numberMatched
+                and fetch them in parallel. Rows are still returned in OBJECTID order.
+            refresh: ignore any dataset_cache entry and download again
+            aoi: optional area of interest (see aoi_geometry). The AOI is split into
+                tile_size tiles, tiles outside the AOI are skipped and the rest are
+                fetched independently (max_workers at a time) and de-duplicated by OBJECTID.
+                Each tile is requested with an INTERSECTS filter (see aoi_filter) and only
+                features intersecting the AOI are returned
+            tile_size: tile edge length in metres, default TILE_SIZE, 0 for a single tile
+            resume: checkpoint completed pages to disk. After a failure (WFSError) the
+                same call with resume=True only downloads the missing pages
+            result: 'geopandas' (default) or 'arrow'. 'arrow' returns a pyarrow Table with
+                WKB (geoarrow.wkb) geometry. Use arrow_to_df to build the GeoDataFrame later
+            spill_cache: optional SpillCache owned by the caller for result='arrow'. The
+                table (and every table sliced or filtered from it) then memory maps its
+                chunk files instead of copying them, close the cache once they are no
+                longer used. Without it the table is read into memory
         
         example usage:
         wfs = WFS_downloader
         r = wfs.get_data('WHSE_IMAGERY_AND_BASE_MAPS.GSR_AIRPORTS_SVW')
+        r = wfs.get_data('WHSE_FOREST_VEGETATION.VEG_COMP_LYR_R1_POLY', bbox=bbox, max_workers=4)
+        r = wfs.get_data('WHSE_FOREST_VEGETATION.VEG_COMP_LYR_R1_POLY', aoi=uwr_df, max_workers=4)
+        with SpillCache(format='arrow') as cache:
+            table = wfs.get_data('WHSE_FOREST_VEGETATION.VEG_COMP_LYR_R1_POLY', bbox=bbox, result='arrow',
+                                 spill_cache=cache)
         TODO: discover OBJECTID , discover GEOMETRY Column name (SHAPE,GEOMETRY,geom,the_geom)
         '''
         
-        pagesize = self.PAGESIZE
-        availiable_memory = psutil.virtual_memory().available
-        logging.info(f"Memory available: {availiable_memory}")
-    
-        r = self.wfs_query(dataset=dataset, query=query, fields=fields, bbox=bbox)
-        matched = int(r.get('numberMatched'))
-        returned = int(r.get('numberReturned'))
-        logging.debug(f"matched features {matched}")
-        logging.info(f"returned features {returned}")
-        if self.data_crs is None:
-            self.data_crs = r['crs']['properties']['name'].split('crs:')[1].replace('::', ':')
-        features = r.get('features')
-        if self.data_geom_column is None:
-            self.data_geom_column = features[0]['geometry_name'].lower()
-    
-        while returned < matched:
-            
-            pagesize=self.adjust_pagesize_by_memory(self.PAGESIZE, psutil.virtual_memory().available)
-            logging.debug(f'page is {pagesize}')
-            
-            logging.debug("")
-            start_index = returned
-            current_features = self.wfs_query(dataset=dataset, query=query, fields=fields, bbox=bbox,
-                                              start_index=start_index, count=pagesize)
-            returned += int(current_features.get('numberReturned'))
-            logging.info(f"total returned features {returned}")
-            features += current_features.get('features')
-            logging.debug(f"features on deck {len(features)}")
-            self.MEMORY_RATE = availiable_memory - psutil.virtual_memory().available
-            logging.debug(f"memory rate {self.MEMORY_RATE}")
-            if not current_features:
-                break
+        if aoi is not None:
+            aoi = self.aoi_geometry(aoi)
+            if tile_size is None:
+                tile_size = self.TILE_SIZE
+        key, params, cached = self.__cache_lookup__(dataset, query, fields, bbox, refresh,
+                                                    aoi=aoi, tile_size=tile_size)
+        if cached is not None:
+            if result == 'arrow':
+                return pyarrow.parquet.read_table(cached, memory_map=True)
+            return geopandas.read_parquet(cached)
+        if max_workers is None:
+            max_workers = self.MAX_WORKERS
+        if aoi is not None:
+            df = self.__get_tiled__(dataset, aoi, tile_size, query=query, fields=fields,
+                                    max_workers=max_workers, resume=resume)
+            if key is not None and len(df) > 0:
+                self.dataset_cache.put(key, df, params)
+            if result == 'arrow':
+                return self.__df_to_arrow__(df)
+            return df
+        logging.info(f"Memory budget: {self.memory.budget}, process RSS: {self.memory.rss()}")
     
-            if len(features) >= pagesize:
-                logging.debug(f"# of features {len(features)}")
-                self.__data_cache__(features=features)
-                
-            features = []
-                
-        if len(self.CACHE_FILES) > 0:
-            # handle cached features
-            if len(features) > 0:
-                self.__data_cache__(features=features)
-                features = []
-            df = self.__load_cache_to_dataframe__()
+        # spill files live in their own directory for this download and are
+        # removed when it finishes, fails or is interrupted, unless the caller owns it
+        keep_cache = result == 'arrow' and spill_cache is not None
+        if keep_cache:
+            self.cache = spill_cache
         else:
-            df = self.features_to_df(features=features)
+            self.cache = SpillCache(root=self.CACHE_DIR, prefix=f'{dataset}_', max_bytes=self.CACHE_MAX_BYTES,
+                                    format='arrow' if result == 'arrow' else 'parquet')
+        self.CACHE_FILES = self.cache.files
+        try:
+            frames = []
+            rows = 0
+            for current_features in self.__iter_responses__(dataset, query=query, fields=fields,
+                                                            bbox=bbox, max_workers=max_workers,
+                                                            resume=resume):
+                if int(current_features.get('numberReturned')) == 0:
+                    continue
+                frames.append(self.page_to_df(current_features))
+                rows += len(frames[-1])
+                logging.debug(f"features on deck {rows}")
+        
+                if rows >= self.memory.spill_rows():
+                    logging.debug(f"# of features {rows}")
+                    self.__data_cache__(self.__concat__(frames))
+                    frames = []
+                    rows = 0
+                    
+            if result == 'arrow':
+                # every row goes through the spill files so the table can map them
+                if len(frames) > 0:
+                    self.__data_cache__(self.__concat__(frames))
+                    frames = []
+                if len(self.CACHE_FILES) == 0:
+                    return pyarrow.table({})
+                table = self.cache.read_arrow(memory_map=keep_cache)
+                if key is not None:
+                    self.dataset_cache.put_table(key, table, params)
+                return table
+            if len(self.CACHE_FILES) > 0:
+                # handle cached features
+                if len(frames) > 0:
+                    self.__data_cache__(self.__concat__(frames))
+                    frames = []
+                df = self.__load_cache_to_dataframe__()
+            else:
+                df = self.__concat__(frames)
+        finally:
+            if not keep_cache:
+                self.cache.close()
+            self.CACHE_FILES = []
     
+        if key is not None and len(df) > 0:
+            self.dataset_cache.put(key, df, params)
         return df
 
-    def wfs_query(self,dataset, query=None, fields=None,bbox=None,start_index = None, count=None): 
-        '''Returns dataset in json format'''
-        
+    def arrow_to_df(self, table) -> geopandas.GeoDataFrame:
+        '''Builds a GeoDataFrame from a get_data(result='arrow') table
+        usage:
+            with SpillCache(format='arrow') as cache:
+                table = wfs.get_data('WHSE_FOREST_VEGETATION.VEG_COMP_LYR_R1_POLY', bbox=bbox, result='arrow',
+                                     spill_cache=cache)
+                df = wfs.arrow_to_df(table.filter(pyarrow.compute.field('PROJ_AGE_1') > 80))
+        '''
+        return geopandas.GeoDataFrame.from_arrow(table)
+
+    def __get_tiled__(self, dataset, aoi, tile_size, query=None, fields=None, max_workers=1,
+                      id_field='OBJECTID', resume=False) -> geopandas.GeoDataFrame:
+        '''Downloads every AOI tile independently and merges them, dropping
+           features repeated along tile edges'''
+        tiles = self.plan_tiles(aoi, tile_size)
+
+        shapely.prepare(aoi)
+
+        def fetch_tile(tile):
+            # each tile is filtered by the part of the AOI inside it, then clipped exactly
+            tile_filter = self.aoi_filter(aoi.intersection(shapely.box(*tile[:4])))
+            tile_query = f'({query}) AND {tile_filter}' if query else tile_filter
+            batches = []
+            for df in self.iter_batches(dataset, query=tile_query, fields=fields, bbox=tile, max_workers=1,
+                                        resume=resume):
+                batches.append(df[df.geometry.intersects(aoi)])
+            return batches
+
+        batches = []
+        # the tiles add up to one progress with a single ETA
+        self.metrics.begin(dataset)
+        try:
+            with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as pool:
+                for tile, tile_batches in zip(tiles, pool.map(fetch_tile, tiles)):
+                    logging.debug(f"tile {tile} returned {sum(len(b) for b in tile_batches)} features")
+                    batches += tile_batches
+        finally:
+            self.metrics.finish(dataset)
+        if not batches:
+            return geopandas.GeoDataFrame()
+        df = geopandas.GeoDataFrame(pandas.concat(batches, ignore_index=True), crs=self.data_crs)
+        total = len(df)
+        if id_field in df.columns:
+            df = df.drop_duplicates(subset=id_field).sort_values(id_field, ignore_index=True)
+        logging.info(f"Merged {len(tiles)} tiles, removed {total - len(df)} duplicate edge features")
+        return df
+
+    def iter_batches(self, dataset, query=None, fields=None, bbox=None, max_workers=None, resume=False):
+        '''Yields one GeoDataFrame per WFS page without holding the full dataset
+        params:
+            same as get_data
+        usage:
+            for df in wfs.iter_batches('WHSE_FOREST_VEGETATION.VEG_COMP_LYR_R1_POLY', bbox=bbox):
+                print(len(df))
+        '''
+        if max_workers is None:
+            max_workers = self.MAX_WORKERS
+        for r in self.__iter_responses__(dataset, query=query, fields=fields, bbox=bbox,
+                                         max_workers=max_workers, resume=resume):
+            if int(r.get('numberReturned')) == 0:
+                continue
+            yield self.page_to_df(r)
+
+    def download_to_parquet(self, dataset, path, query=None, fields=None, bbox=None, max_workers=None,
+                            refresh=False, resume=False) -> str:
+        '''Streams a dataset to a GeoParquet file, one row group per WFS page.
+           Memory use is bound by the page size rather than the dataset size.
+           Pages are written to <path>.part which replaces path once the download
+           is complete, a failed download leaves path as it was.
+        params:
+            path: output GeoParquet file
+            others: same as get_data
+        returns: path
+        usage:
+            wfs.download_to_parquet('WHSE_FOREST_VEGETATION.VEG_COMP_LYR_R1_POLY', 'VRI.parquet', bbox=bbox)
+        '''
+        key, params, cached = self.__cache_lookup__(dataset, query, fields, bbox, refresh)
+        if cached is not None:
+            shutil.copyfile(cached, path)
+            return path
+        writer = None
+        part = f'{path}.part'
+        try:
+            for df in self.iter_batches(dataset, query=query, fields=fields, bbox=bbox,
+                                        max_workers=max_workers, resume=resume):
+                table = self.__df_to_arrow__(df)
+                if writer is None:
+                    # an all null column on the first page has no type, store it as text
+                    schema = pyarrow.schema([pyarrow.field(f.name, pyarrow.string()) if pyarrow.types.is_null(f.type) else f
+                                             for f in table.schema], metadata=table.schema.metadata)
+                    writer = pyarrow.parquet.ParquetWriter(part, schema)
+                writer.write_table(self.__conform_table__(table, writer.schema))
+                logging.debug(f'Wrote {table.num_rows} features to {part}')
+        except BaseException:
+            if writer is not None:
+                writer.close()
+                os.remove(part)
+            raise
+        if writer is None:
+            logging.warning(f'No features returned for {dataset}, nothing written to {path}')
+            return path
+        writer.close()
+        os.replace(part, path)
+        if key is not None:
+            self.dataset_cache.put_file(key, path, params)
+        return path
+
+    def sync(self, dataset, path, query=None, fields=None, bbox=None, date_field=None,
+             id_field='OBJECTID', max_workers=None) -> dict:
+        '''Incrementally refreshes a GeoParquet copy of a dataset written by download_to_parquet.
+           Only the OBJECTID list, new records and (with date_field) records changed since
+           the last pull are requested. Retired records are dropped from the file.
+           Without date_field only inserts and deletes are synced: records edited on the
+           server keep their stored values until the file is downloaded again.
+        params:
+            path: GeoParquet file to refresh, downloaded in full if missing
+            date_field: optional update date attribute (eg. FEATURE_CHANGE_DATE), required to
+                pick up edited records
+            id_field: unique feature id attribute
+            others: same as get_data
+        returns: dict of added, updated, deleted and unchanged record counts
+        usage:
+            wfs.sync('WHSE_FOREST_VEGETATION.VEG_COMP_LYR_R1_POLY', 'VRI.parquet', bbox=bbox)
+        '''
+        if fields:
+            fields = list(fields) + [f for f in (id_field, date_field) if f and f.upper() not in
+                                     [x.upper() for x in fields]]
+        if not os.path.exists(path):
+            self.download_to_parquet(dataset, path, query=query, fields=fields, bbox=bbox,
+                                     max_workers=max_workers, refresh=True)
+            added = pyarrow.parquet.ParquetFile(path).metadata.num_rows if os.path.exists(path) else 0
+            return {'added': added, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+
+        stored = geopandas.read_parquet(path)
+        stored_ids = set(stored[id_field].tolist())
+        server_ids = set()
+        for r in self.__iter_responses__(dataset, query=query, fields=[id_field], bbox=bbox,
+                                         max_workers=max_workers or self.MAX_WORKERS):
+            if int(r.get('numberReturned')) > 0:
+                server_ids.update(self.page_to_df(r)[id_field].tolist())
+        deleted = stored_ids - server_ids
+        if date_field is None:
+            logging.info(f'{dataset}: no date_field, edited records are not synced')
+        logging.info(f'{dataset}: {len(server_ids - stored_ids)} new and {len(deleted)} retired records')
+
+        # new ids are requested in small IN lists to keep the url short, changed records by date
+        filters = []
+        new_ids = sorted(server_ids - stored_ids)
+        for i in range(0, len(new_ids), 500):
+            filters.append(f"{id_field} IN ({','.join(str(x) for x in new_ids[i:i + 500])})")
+        if date_field is not None and stored[date_field].notna().any():
+            # edits stamped with the stored maximum are included, the checksums below drop unchanged rows
+            last = stored[date_field].dropna().map(self.__timestamp__).max()
+            filters.append(f"{date_field} >= {self.cql_datetime(last)}")
+        batches = []
+        for cql in filters:
+            if query:
+                cql = f'({query}) AND {cql}'
+            batches += list(self.iter_batches(dataset, query=cql, fields=fields, bbox=bbox,
+                                              max_workers=max_workers))
+        delta = geopandas.GeoDataFrame(pandas.concat(batches, ignore_index=True)) if batches else None
+        if delta is not None:
+            delta = delta.drop_duplicates(subset=id_field, keep='last')
+
+        # keep delta records whose content really changed, both sides are hashed with the stored
+        # column types (eg. a nullable integer read back as float64 and the int64 of a fresh page)
+        updated = set()
+        if delta is not None:
+            schema = pyarrow.parquet.read_schema(path)
+            old = stored[stored[id_field].isin(delta[id_field])]
+            new = delta[delta[id_field].isin(old[id_field])]
+            old_sums = self.feature_checksums(old, schema).set_axis(old[id_field])
+            new_sums = self.feature_checksums(new, schema).set_axis(new[id_field])
+            changed = new_sums != old_sums.reindex(new_sums.index)
+            updated = set(new_sums.index[changed])
+            delta = delta[~delta[id_field].isin(old[id_field]) | delta[id_field].isin(updated)]
+        added = 0 if delta is None else len(delta) - len(updated)
+        stats = {'added': added, 'updated': len(updated), 'deleted': len(deleted),
+                 'unchanged': len(stored) - len(deleted) - len(updated)}
+        logging.info(f'{dataset} sync: {stats}')
+        if added == 0 and len(updated) == 0 and len(deleted) == 0:
+            return stats
+
+        keep = stored[~stored[id_field].isin(deleted | updated)]
+        parts = [keep] if delta is None else [keep, delta.to_crs(keep.crs) if keep.crs else delta]
+        merged = geopandas.GeoDataFrame(pandas.concat(parts, ignore_index=True), crs=keep.crs)
+        merged = merged.sort_values(id_field, ignore_index=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        merged.to_parquet(tmp)
+        os.replace(tmp, path)
+        return stats
+
+    def __timestamp__(self, value) -> pandas.Timestamp:
+        '''Returns a date, timestamp or WFS date string (eg. 2023-01-01Z) as a UTC Timestamp'''
+        if isinstance(value, str):
+            value = re.sub(r'^(\d{4}-\d{2}-\d{2})Z$', r'\1', value)
+        ts = pandas.Timestamp(value)
+        return ts.tz_localize('UTC') if ts.tzinfo is None else ts.tz_convert('UTC')
+
+    def cql_datetime(self, value) -> str:
+        '''Formats a date or timestamp as a CQL date-time literal
+        usage:
+            wfs.cql_datetime('2023-01-01Z') -> '2023-01-01T00:00:00Z'
+        '''
+        # truncated to whole seconds, comparisons against it use >= so nothing is missed
+        return self.__timestamp__(value).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def register_parquet(self, name, path) -> str:
+        '''Registers GeoParquet file(s) as a DuckDB view on self.con so they can be
+           queried with spatial SQL without loading them into GeoPandas.
+           The geometry column is exposed as a DuckDB GEOMETRY.
+        params:
+            name: view name
+            path: GeoParquet file or glob, eg. a download_to_parquet output
+        returns: name
+        usage:
+            wfs.register_parquet('vri', 'VRI.parquet')
+        '''
+        files = sorted(glob.glob(path))
+        if not files:
+            raise FileNotFoundError(f"No parquet files match {path}")
+        geo = json.loads(pyarrow.parquet.read_schema(files[0]).metadata.get(b'geo', b'{}'))
+        geom_col = geo.get('primary_column', 'geometry')
+        # view definitions cannot take prepared parameters, the path is inlined as an escaped literal
+        view = self.__sql_identifier__(name)
+        source = "read_parquet('{}')".format(path.replace("'", "''"))
+        self.con.execute(f"CREATE OR REPLACE VIEW {view} AS SELECT * FROM {source}")
+        types = dict(self.con.execute("SELECT column_name, data_type FROM information_schema.columns "
+                                      "WHERE table_name = ?", [name]).fetchall())
+        if types.get(geom_col) == 'BLOB':
+            # older duckdb versions leave GeoParquet geometry as WKB
+            geom = self.__sql_identifier__(geom_col)
+            self.con.execute(f"CREATE OR REPLACE VIEW {view} AS SELECT * REPLACE "
+                             f"(ST_GeomFromWKB({geom}) AS {geom}) FROM {source}")
+        logging.info(f"Registered {path} as duckdb view {name}")
+        return name
+
+    def __sql_identifier__(self, name) -> str:
+        '''Returns name quoted as a DuckDB identifier'''
+        return '"{}"'.format(name.replace('"', '""'))
+
+    def download_to_duckdb(self, dataset, name, path=None, **kwargs) -> str:
+        '''Streams a dataset to GeoParquet (see download_to_parquet) and registers it as a DuckDB view
+        params:
+            name: view name
+            path: GeoParquet file, default a new CACHE_DIR/<name>_*.parquet file so downloads
+                never overwrite a file another view reads
+            kwargs: download_to_parquet options (query, fields, bbox, max_workers, ...)
+            The ST_* functions need the DuckDB spatial extension, see duckdb_connection.
+        usage:
+            wfs.download_to_duckdb('WHSE_FOREST_VEGETATION.VEG_COMP_LYR_R1_POLY', 'vri', bbox=bbox)
+            wfs.download_to_duckdb('WHSE_WILDLIFE_MANAGEMENT.WCP_UNGULATE_WINTER_RANGE_SP', 'uwr',
+                                   query="UWR_NUMBER = 'u-4-001'")
+            wfs.sql("""SELECT v.BCLCS_LEVEL_4, sum(ST_Area(ST_Intersection(v.geometry, u.geometry))) AS area
+                       FROM vri v JOIN uwr u ON ST_Intersects(v.geometry, u.geometry) GROUP BY 1""").df()
+        '''
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix=f'{name}_', suffix='.parquet', dir=self.CACHE_DIR)
+            os.close(fd)
+        self.download_to_parquet(dataset, path, **kwargs)
+        return self.register_parquet(name, path)
+
+    def sql(self, query) -> duckdb.DuckDBPyRelation:
+        '''Runs SQL on the DuckDB connection and returns the lazy relation.
+           Use .df(), .arrow() or .write_parquet() on the result to materialize it.
+        '''
+        return self.con.sql(query)
+
+    def sql_to_df(self, query, crs=None) -> geopandas.GeoDataFrame:
+        '''Runs SQL and returns a GeoDataFrame, geometry is passed back as WKB.
+           Results without a GEOMETRY column are returned as a pandas DataFrame.
+        params:
+            query: SQL
+            crs: result crs, default data_crs
+        '''
+        relation = self.con.sql(query)
+        geom_cols = [c for c, t in zip(relation.columns, relation.types) if str(t).startswith('GEOMETRY')]
+        if not geom_cols:
+            return relation.df()
+        wkb = ', '.join(f'ST_AsWKB("{c}") AS "{c}"' for c in geom_cols)
+        df = self.con.sql(f"SELECT * REPLACE ({wkb}) FROM ({query})").df()
+        for column in geom_cols:
+            df[column] = geopandas.GeoSeries.from_wkb(df[column].map(lambda b: None if b is None else bytes(b)))
+        return geopandas.GeoDataFrame(df, geometry=geom_cols[0], crs=crs or self.data_crs)
+
+    def feature_checksums(self, df, schema=None) -> pandas.Series:
+        '''Returns a uint64 checksum per row of a GeoDataFrame from its attributes and WKB geometry
+        params:
+            schema: optional arrow schema (eg. of a stored GeoParquet file) the columns are ordered,
+                filled and cast to first, so frames with different dtypes for the same values match
+        '''
+        if schema is None:
+            return pandas.util.hash_pandas_object(df.to_wkb(), index=False).set_axis(df.index)
+        table = self.__conform_table__(self.__df_to_arrow__(df), schema)
+        return pandas.util.hash_pandas_object(table.to_pandas(), index=False).set_axis(df.index)
+
+    def __df_to_arrow__(self, df) -> pyarrow.Table:
+        '''Converts a GeoDataFrame to an arrow table with WKB geometry tagged as geoarrow.wkb
+           and GeoParquet metadata'''
+        geom_col = df.geometry.name
+        table = pyarrow.Table.from_pandas(df.to_wkb(), preserve_index=False)
+        crs = df.crs.to_json_dict() if df.crs is not None else None
+        index = table.schema.get_field_index(geom_col)
+        field = table.schema.field(index).with_metadata(
+            {b'ARROW:extension:name': b'geoarrow.wkb',
+             b'ARROW:extension:metadata': json.dumps({'crs': crs} if crs else {}).encode('utf-8')})
+        table = table.cast(table.schema.set(index, field))
+        geo = {'version': '1.0.0',
+               'primary_column': geom_col,
+               'columns': {geom_col: {'encoding': 'WKB',
+                                      'geometry_types': [],
+                                      'crs': crs}}}
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'geo'] = json.dumps(geo).encode('utf-8')
+        return table.replace_schema_metadata(metadata)
+
+    def __conform_table__(self, table, schema) -> pyarrow.Table:
+        '''Orders, fills and casts table columns to match schema'''
+        columns = []
+        for field in schema:
+            if field.name in table.column_names:
+                columns.append(table.column(field.name).cast(field.type))
+            else:
+                columns.append(pyarrow.nulls(table.num_rows, type=field.type))
+        return pyarrow.Table.from_arrays(columns, schema=schema)
+
+    def get_output_formats(self, dataset=None) -> list:
+        '''Returns the GetFeature outputFormat values listed in the WFS GetCapabilities.
+           With a dataset the small per layer capabilities document is requested.
+        usage:
+            wfs.get_output_formats('WHSE_FOREST_VEGETATION.VEG_COMP_LYR_R1_POLY')
+        '''
+        url = self.SERVICE_URL
+        if dataset is not None:
+            # eg. https://openmaps.gov.bc.ca/geo/pub/WHSE_FOREST_VEGETATION.VEG_COMP_LYR_R1_POLY/ows?
+            url = f"{url.rstrip('?').rsplit('/', 1)[0]}/{dataset}/ows?"
+        if url not in self.output_formats:
+            r = self.session.get(url, params={'service': 'WFS', 'version': '2.0.0', 'request': 'GetCapabilities'},
+                                 timeout=self.TIMEOUT)
+            r.raise_for_status()
+            ows = '{http://www.opengis.net/ows/1.1}'
+            root = xml.etree.ElementTree.fromstring(r.content)
+            formats = []
+            for operation in root.iter(f'{ows}Operation'):
+                if operation.get('name') != 'GetFeature':
+                    continue
+                for parameter in operation.iter(f'{ows}Parameter'):
+                    if parameter.get('name') == 'outputFormat':
+                        formats += [value.text for value in parameter.iter(f'{ows}Value')]
+            logging.debug(f"WFS output formats: {formats}")
+            self.output_formats[url] = formats
+        return self.output_formats[url]
+
+    def output_format(self, dataset=None) -> str:
+        '''Returns the outputFormat sent with GetFeature requests for dataset, see OUTPUT_FORMAT.
+           'auto' is resolved once per dataset from its own capabilities.
+        '''
+        if dataset not in self.resolved_output_formats:
+            output_format = self.OUTPUT_FORMAT
+            if output_format == 'auto':
+                try:
+                    offered = {f.lower(): f for f in self.get_output_formats(dataset)}
+                except (requests.exceptions.RequestException, xml.etree.ElementTree.ParseError) as e:
+                    logging.warning(f"Could not read WFS capabilities, using json: {e}")
+                    offered = {}
+                if pyogrio is None:
+                    offered = {}
+                output_format = next((offered[f.lower()] for f in self.PREFERRED_FORMATS
+                                      if f.lower() in offered), 'json')
+                logging.info(f"Using WFS output format {output_format} for {dataset}")
+            self.resolved_output_formats[dataset] = output_format
+        return self.resolved_output_formats[dataset]
+
+    def __is_json__(self, output_format) -> bool:
+        return 'json' in output_format.lower()
+
+    def wfs_query(self,dataset, query=None, fields=None,bbox=None,start_index = None, count=None, hits=False): 
+        '''Returns dataset in json format, raises WFSError once MAX_RETRIES attempts fail.
+           With hits only numberMatched is requested and returned as an int.
+        '''
+        request = dict(query=query, fields=fields, bbox=bbox, start_index=start_index, count=count)
         if fields is None:
             fields = []
         url = self.SERVICE_URL
@@ -174,7 +1509,7 @@ class WFS_downloader:
             'version': '2.0.0',
             'request': 'GetFeature',
             'typeName': f'pub:{dataset}',
-            'outputFormat':'json',
+            'outputFormat':self.output_format(dataset),
             "srsName": "EPSG:3005",
             'sortBy':'OBJECTID',
             'limit' : 10000,
@@ -182,9 +1517,9 @@ class WFS_downloader:
             }
         # build optional params
         if bbox is not None and query is not None:
-            # append bbox to cql
-            bbox = [str(b) for b in bbox]
-            bbox_str = f'BBOX(GEOMETRY,{",".join(bbox)})'
+            # append bbox to cql, the srs name is a string literal in CQL
+            bbox = [str(b) if isinstance(b, (int, float)) else f"'{b}'" for b in bbox]
+            bbox_str = f'BBOX({self.GEOMETRY_FIELD},{",".join(bbox)})'
             query = f'{bbox_str} AND {query}'
         elif bbox is not None:
             bbox = [str(b) for b in bbox]
@@ -202,24 +1537,196 @@ class WFS_downloader:
             params['startIndex'] = start_index
         if count:
             params['count'] = count
+        if hits:
+            params['resultType'] = 'hits'
+            del params['outputFormat']
             
-        for attempt in range (self.MAX_RETRIES):
-            r = requests.get(url, params)
+        # long filters (eg. AOI polygons) do not fit in a GET url
+        use_post = len(requests.Request('GET', url, params=params).prepare().url) > self.MAX_URL_LENGTH
+        # 5xx, timeouts, dropped connections, empty and truncated json are retried
+        # with exponential backoff and full jitter, other errors fail straight away
+        attempts = max(1, self.MAX_RETRIES)
+        error = None
+        for attempt in range(attempts):
+            if attempt > 0:
+                delay = random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF * 2 ** (attempt - 1)))
+                logging.warning(f"{error}. Retrying in {delay:.1f}s ({attempt + 1}/{attempts})...")
+                self.metrics.emit({'event': 'retry', 'dataset': dataset, 'start_index': start_index or 0,
+                                   'attempt': attempt + 1, 'error': error, 'delay': delay})
+                time.sleep(delay)
+            try:
+                opened = self.__connections_opened__(url)
+                # the whole exchange including the body download, r.elapsed stops at the headers
+                sent = time.perf_counter()
+                if use_post:
+                    r = self.session.post(url, data=params, timeout=self.TIMEOUT)
+                else:
+                    r = self.session.get(url, params=params, timeout=self.TIMEOUT)
+                latency = time.perf_counter() - sent
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError) as e:
+                error = f"WFS request failed: {e}"
+                continue
             logging.debug(f"WFS URL request: {r.url}")
-            if r.status_code == 502:
-                logging.warning(f"502 Bad Gateway. Retrying ({attempt + 1}/{self.MAX_RETRIES})...")
-            else:
-                break
-    
-        if r.status_code != 200:
-            logging.error(f"Error from WFS service. Status code: {r.status_code}")
-            return {}
-        
-        if not r.text:
-            logging.warning("Empty response received from WFS service.")
-            return {}
-        
-        return r.json()
+            new_connections = self.__connections_opened__(url) - opened
+            logging.debug(f"WFS response in {r.elapsed.total_seconds():.3f}s, "
+                          f"{len(r.content)} bytes ({r.headers.get('Content-Encoding', 'identity')}), "
+                          f"{'new connection' if new_connections > 0 else 'reused connection'}")
+            if r.status_code >= 500:
+                error = f"{r.status_code} {r.reason}"
+                continue
+            if r.status_code == 400 and not hits and not self.__is_json__(params['outputFormat']):
+                # the layer does not offer the format after all, json always works
+                logging.warning(f"{dataset} rejected outputFormat {params['outputFormat']}, using json: {r.text[:200]}")
+                self.resolved_output_formats[dataset] = 'json'
+                return self.wfs_query(dataset, **request)
+            if r.status_code != 200:
+                logging.error(f"Error from WFS service. Status code: {r.status_code}")
+                raise WFSError(f"WFS request failed with status {r.status_code}: {r.text[:500]}")
+            if not r.content:
+                error = "Empty response received from WFS service"
+                continue
+            try:
+                if hits:
+                    return self.__decode_hits__(r.content)
+                start = time.perf_counter()
+                page = self.decode_page(r.content, params['outputFormat'])
+                page['stats'] = {'start_index': start_index or 0,
+                                 'latency': latency,
+                                 'wire_bytes': self.__wire_bytes__(r),
+                                 'decode_seconds': time.perf_counter() - start,
+                                 'retries': attempt}
+                return page
+            except ValueError as e:
+                error = f"Truncated or invalid json from WFS service: {e}"
+                continue
+
+        logging.error(f"WFS request failed after {attempts} attempts: {error}")
+        raise WFSError(f"WFS request failed after {attempts} attempts: {error}")
+
+    def __wire_bytes__(self, r):
+        '''Returns the (compressed) bytes of a response body read off the socket, None when unknown'''
+        try:
+            wire_bytes = r.raw.tell()
+        except (AttributeError, OSError):
+            wire_bytes = 0
+        if wire_bytes:
+            return wire_bytes
+        if 'Content-Length' in r.headers:
+            return int(r.headers['Content-Length'])
+        return None
+
+    def __decode_hits__(self, content) -> int:
+        '''Returns numberMatched from a resultType=hits response (xml or json)'''
+        m = re.search(rb'numberMatched["\s:=]*"?(\d+)', content)
+        if m is None:
+            raise ValueError("numberMatched missing from hits response")
+        return int(m.group(1))
+
+    def __decode_binary__(self, content) -> dict:
+        '''Decodes a FlatGeobuf, GeoPackage or zipped Shapefile WFS response body'''
+        with warnings.catch_warnings():
+            # GDAL complains that in memory GeoPackages have no .gpkg extension
+            warnings.filterwarnings('ignore', message='.*non conformant file extension.*')
+            df = pyogrio.read_dataframe(io.BytesIO(content), use_arrow=True)
+        if 'OBJECTID' in df.columns:
+            # a FlatGeobuf spatial index stores features in hilbert order, restore the sortBy order
+            df = df.sort_values('OBJECTID', ignore_index=True)
+        page = {'content': content, 'df': df, 'numberMatched': None, 'numberReturned': len(df)}
+        if df.crs is not None and df.crs.to_epsg() is not None:
+            page['crs'] = {'type': 'name', 'properties': {'name': f'urn:ogc:def:crs:EPSG::{df.crs.to_epsg()}'}}
+        return page
+
+    def decode_page(self, content, output_format='json') -> dict:
+        '''Decodes a GeoJSON WFS response body.
+           With FAST_DECODE and pyogrio installed only the paging members are read
+           from the document (GeoServer writes them after the features) and the
+           body is kept as 'content' for page_to_df to read with GDAL in one
+           columnar pass. Otherwise the whole body is parsed into dicts (with orjson
+           when installed). Raises ValueError for truncated or invalid json.
+           Non json output formats (see OUTPUT_FORMAT) are decoded to a GeoDataFrame
+           kept as 'df', unless the service answered with json anyway.
+        params:
+            output_format: the outputFormat the page was requested in
+        '''
+        if not self.__is_json__(output_format) and not content.lstrip()[:1] == b'{':
+            if pyogrio is None:
+                raise ImportError(f"pyogrio is required to read WFS output format {output_format}")
+            try:
+                page = self.__decode_binary__(content)
+                page['bytes'] = len(content)
+                return page
+            except pyogrio.errors.DataSourceError as e:
+                raise ValueError(f"Could not read {output_format} response: {e}")
+        page = self.__decode_json__(content)
+        page['bytes'] = len(content)
+        return page
+
+    def __decode_json__(self, content) -> dict:
+        if self.FAST_DECODE and pyogrio is not None:
+            if not content.rstrip().endswith(b'}'):
+                raise ValueError("response body is truncated")
+            tail = content[-4096:]
+            page = {'content': content}
+            for member in ('numberMatched', 'numberReturned'):
+                m = re.search(rb'"' + member.encode() + rb'"\s*:\s*(\d+)', tail) or \
+                    re.search(rb'"' + member.encode() + rb'"\s*:\s*(\d+)', content)
+                if m is None:
+                    raise ValueError(f"{member} missing from response")
+                page[member] = int(m.group(1))
+            m = re.search(rb'"crs"\s*:\s*\{.*?"name"\s*:\s*"([^"]+)"', tail, re.S)
+            if m is not None:
+                page['crs'] = {'type': 'name', 'properties': {'name': m.group(1).decode()}}
+            m = re.search(rb'"geometry_name"\s*:\s*"([^"]+)"', content[:65536])
+            if m is not None:
+                page['geometry_name'] = m.group(1).decode()
+            return page
+        if orjson is not None:
+            return orjson.loads(content)
+        return json.loads(content)
+
+    def page_to_df(self, page, crs=None) -> geopandas.GeoDataFrame:
+        '''Returns a decoded WFS page as a GeoDataFrame in crs, default data_crs'''
+        start = time.perf_counter()
+        df = self.__page_to_df__(page, crs or self.data_crs)
+        self.metrics.add_time('convert_seconds', time.perf_counter() - start)
+        return df
+
+    def __page_to_df__(self, page, crs) -> geopandas.GeoDataFrame:
+        if 'df' in page:
+            df = page['df']
+        elif 'content' in page:
+            df = pyogrio.read_dataframe(io.BytesIO(page['content']), use_arrow=True, DATE_AS_STRING='YES')
+            # match features_to_df: no feature id column, geometry first, 64 bit integers
+            # and columns without any value left as object None
+            df = df.drop(columns=[c for c in ('id',) if c in df.columns])
+            geom_col = df.geometry.name
+            df = df[[geom_col] + [c for c in df.columns if c != geom_col]]
+            for column in df.columns:
+                if column == geom_col:
+                    continue
+                if str(df[column].dtype) == 'int32':
+                    df[column] = df[column].astype('int64')
+                elif df[column].isna().all():
+                    df[column] = pandas.Series([None] * len(df), index=df.index, dtype=object)
+        else:
+            df = self.features_to_df(features=page.get('features'))
+        if crs is not None:
+            df = df.set_crs(crs, allow_override=True)
+        return df
+
+    def __concat__(self, frames, crs=None) -> geopandas.GeoDataFrame:
+        '''Concatenates page GeoDataFrames, crs defaults to data_crs'''
+        if not frames:
+            return geopandas.GeoDataFrame()
+        if len(frames) == 1:
+            return frames[0]
+        return geopandas.GeoDataFrame(pandas.concat(frames, ignore_index=True), crs=crs or self.data_crs)
+
+    def __connections_opened__(self, url) -> int:
+        '''Returns the number of connections the session has opened for url's adapter'''
+        pools = self.session.get_adapter(url).poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
 
     def geojson_from_file(self,geojson_file):
         ''' Reads GeoJson file to list of features (GeoJSON)
@@ -246,3 +1753,124 @@ class WFS_downloader:
         df = geopandas.GeoDataFrame.from_features(fc['features'])
         logging.debug(f'Loading Complete')
         return df
+
+
+class AsyncWFS_downloader(WFS_downloader):
+    ''' asyncio counterpart of WFS_downloader that downloads several datasets and all
+        of their pages concurrently. Every WFS request of every dataset in a fetch_many
+        call shares one limit of max_in_flight requests, so the total time follows the
+        largest dataset rather than the sum of all of them. Requests still go through
+        wfs_query (retries, POST for long filters, output formats) on worker threads.
+        Each call has its own request limit and worker pool, so calls may overlap on one
+        instance. Every dataset is held in memory, use download_to_parquet for very
+        large layers.
+    params:
+        max_in_flight: WFS requests running at once across all datasets, default MAX_IN_FLIGHT
+        dataset_cache, memory_budget: see WFS_downloader
+    usage:
+        wfs = AsyncWFS_downloader(max_in_flight=8)
+        uwr, vri = await wfs.fetch_many([
+            {'dataset': 'WHSE_WILDLIFE_MANAGEMENT.WCP_UNGULATE_WINTER_RANGE_SP', 'query': "UWR_NUMBER = 'u-4-001'"},
+            {'dataset': 'WHSE_FOREST_VEGETATION.VEG_COMP_LYR_R1_POLY', 'bbox': bbox}])
+    '''
+    MAX_IN_FLIGHT = 8
+
+    def __init__(self, max_in_flight=None, dataset_cache=None, memory_budget=None) -> None:
+        super().__init__(dataset_cache=dataset_cache, memory_budget=memory_budget)
+        self.max_in_flight = max_in_flight or self.MAX_IN_FLIGHT
+        if self.max_in_flight > self.POOL_SIZE:
+            # keep a connection for every request in flight
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_in_flight)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+
+    async def fetch_many(self, datasets) -> list:
+        '''Downloads datasets concurrently, returns a list of GeoDataFrames in the same order,
+           each in the crs of its own dataset
+        params:
+            datasets: list of dataset names or dicts of get_data_async arguments
+        usage:
+            layers = asyncio.run(wfs.fetch_many(['WHSE_IMAGERY_AND_BASE_MAPS.GSR_AIRPORTS_SVW',
+                                                 {'dataset': 'WHSE_FOREST_VEGETATION.BEC_BIOGEOCLIMATIC_POLY', 'bbox': bbox}]))
+        '''
+        specs = [{'dataset': d} if isinstance(d, str) else d for d in datasets]
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        # pages are converted to GeoDataFrames on the same pool while other requests wait on the network
+        executor = ThreadPoolExecutor(max_workers=self.max_in_flight * 2)
+        try:
+            return await asyncio.gather(*(self.__get_data_async__(semaphore, executor, **r) for r in specs))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def get_data_async(self, dataset, query=None, fields=None, bbox=None, refresh=False) -> geopandas.GeoDataFrame:
+        '''Returns dataset as a GeoDataFrame, fetching its pages concurrently
+        params:
+            query, fields, bbox, refresh: see get_data
+        usage:
+            df = await wfs.get_data_async('WHSE_IMAGERY_AND_BASE_MAPS.GSR_AIRPORTS_SVW')
+        '''
+        return (await self.fetch_many([{'dataset': dataset, 'query': query, 'fields': fields,
+                                        'bbox': bbox, 'refresh': refresh}]))[0]
+
+    async def __get_data_async__(self, semaphore, executor, dataset, query=None, fields=None, bbox=None,
+                                 refresh=False) -> geopandas.GeoDataFrame:
+        key, params, cached = self.__cache_lookup__(dataset, query, fields, bbox, refresh)
+        if cached is not None:
+            return geopandas.read_parquet(cached)
+        self.metrics.begin(dataset)
+        try:
+            self.memory.mark()
+            run = functools.partial(self.__run_async__, semaphore, executor)
+            r = await run(self.wfs_query, dataset, query=query, fields=fields, bbox=bbox,
+                          count=self.adjust_pagesize_by_memory(self.PAGESIZE))
+            if r.get('numberMatched') is None:
+                # binary output formats carry no paging members
+                r['numberMatched'] = await run(self.wfs_query, dataset, query=query, fields=fields, bbox=bbox, hits=True)
+            matched, returned = self.__first_page__(r, dataset)
+            # data_crs belongs to the first dataset of the instance, each dataset keeps its own
+            crs = self.page_crs(r) or self.data_crs
+            logging.info(f"{dataset}: fetching {matched} features")
+            windows = [self.__window_df_async__(run, executor, dataset, crs, start_index, count,
+                                                query=query, fields=fields, bbox=bbox)
+                       for start_index, count in self.plan_pages(returned, matched, self.PAGESIZE)]
+            frames = [await self.__page_df_async__(executor, r, crs)]
+            for window in await asyncio.gather(*windows):
+                frames += window
+            df = self.__concat__([frame for frame in frames if frame is not None], crs=crs)
+        finally:
+            self.metrics.finish(dataset)
+        logging.info(f"{dataset}: {len(df)} features")
+        if key is not None and len(df) > 0:
+            self.dataset_cache.put(key, df, params)
+        return df
+
+    async def __run_async__(self, semaphore, executor, fn, *args, **kwargs):
+        '''Runs a blocking WFS call on the worker pool once a request slot is free'''
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+    async def __window_df_async__(self, run, executor, dataset, crs, start_index, count, **kwargs) -> list:
+        '''Fetches one planned window (see __fetch_window__), returns its GeoDataFrames'''
+        pages = await run(self.__fetch_window__, dataset, start_index, count, **kwargs)
+        frames = []
+        for page in pages:
+            self.__page_metrics__(dataset, page)
+            frames.append(await self.__page_df_async__(executor, page, crs))
+        return frames
+
+    async def __page_df_async__(self, executor, page, crs):
+        '''Converts a page to a GeoDataFrame, None when it is empty'''
+        if int(page.get('numberReturned')) == 0:
+            return None
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.page_to_df, page, crs)
+
+
+async def fetch_many(datasets, max_in_flight=None, **kwargs) -> list:
+    '''Downloads several WFS datasets concurrently, see AsyncWFS_downloader.fetch_many
+    usage:
+        uwr, bec = asyncio.run(datatools.fetch_many(['WHSE_WILDLIFE_MANAGEMENT.WCP_UNGULATE_WINTER_RANGE_SP',
+                                                     'WHSE_FOREST_VEGETATION.BEC_BIOGEOCLIMATIC_POLY'], max_in_flight=8))
+    '''
+    return await AsyncWFS_downloader(max_in_flight=max_in_flight, **kwargs).fetch_many(datasets)
@@ -12,84 +12,655 @@ import rasterio
 import os
 import numpy as np
 import tempfile
-from osgeo import gdal
+import shutil
+import json
 import geopandas
+import pyarrow
+import pyarrow.parquet
+from pyproj import CRS
 from shapely.geometry import shape
-from rasterio.features import shapes
+from rasterio.features import shapes, rasterize, sieve
 import logging
-from arcgis import GIS
+import shapely
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from rasterio.windows import Window, bounds as window_bounds
 
 logging.basicConfig(level=logging.INFO)
 
+class ClassBreaks:
+    """
+    ClassBreaks assigns raster cells to classes in a single vectorized pass
+
+    classes: dictionary of class name:(low break point, high break point), low is inclusive and high exclusive.
+        Class values are 1, 2, ... in dictionary order, cells outside every class get 0.
+    nodata: optional nodata value, these cells (and NaN) always get 0
+
+    The breaks are sorted once into edges and a lookup table so every cell is binned with one
+    searchsorted regardless of the number of classes. Overlapping breaks raise a ValueError and
+    gaps between breaks are logged and kept in gaps.
+
+    example usage breaks = ClassBreaks({'Low': (0,1000),'High': (1000,np.inf)}, nodata=-9999)
+                  classified = breaks.classify(dem)
+    """
+    def __init__(self, classes, nodata=None) -> None:
+        if not 0 < len(classes) < 256:
+            raise ValueError(f"between 1 and 255 classes are supported, got {len(classes)}")
+        self.names = list(classes.keys())
+        self.labels = np.array(['None'] + self.names, dtype=object)
+        self.nodata = nodata
+        intervals = []
+        for value, (name, (low, high)) in enumerate(classes.items(), 1):
+            if not low < high:
+                raise ValueError(f"class {name} has an empty range ({low}, {high})")
+            intervals.append((low, high, value))
+        intervals.sort()
+        self.gaps = []
+        for (low, high, value), (next_low, next_high, next_value) in zip(intervals, intervals[1:]):
+            if next_low < high:
+                raise ValueError(f"classes {self.names[value-1]} ({low}, {high}) and "
+                    f"{self.names[next_value-1]} ({next_low}, {next_high}) overlap")
+            if next_low > high:
+                self.gaps.append((high, next_low))
+                logging.warning(f"no class covers [{high}, {next_low}), these cells are classified as None")
+        edges = []
+        lut = [0]
+        for low, high, value in intervals:
+            if edges and edges[-1] == low:
+                lut[-1] = value
+            else:
+                edges.append(low)
+                lut.append(value)
+            edges.append(high)
+            lut.append(0)
+        self.edges = np.array(edges, dtype=np.float64)
+        self.lut = np.array(lut, dtype=np.uint8)
+
+    def classify(self, values, nodata=None) -> np.ndarray:
+        """
+        classify returns the uint8 class values for an array of cells
+
+        values: numpy array of raster values
+        nodata: optional nodata value overriding the one given to ClassBreaks
+        """
+        nodata = self.nodata if nodata is None else nodata
+        classified = self.lut[np.searchsorted(self.edges, values, side='right')]
+        if nodata is not None and not np.isnan(nodata):
+            classified[values == nodata] = 0
+        if np.issubdtype(values.dtype, np.floating):
+            classified[np.isnan(values)] = 0
+        return classified
+
+def horn_window(dem, nodata=None) -> tuple:
+    """
+    horn_window returns the Horn 3x3 differences (dx, dy) of the interior cells of dem and a mask
+    of the cells without a full valid window (the array edge and cells next to nodata or NaN)
+
+    dem: 2d elevation array
+    nodata: optional nodata value of dem
+    """
+    dem = dem.astype(np.float64)
+    invalid = np.isnan(dem)
+    if nodata is not None:
+        invalid |= dem == nodata
+    win = lambda a, r, c: a[r:a.shape[0] - 2 + r, c:a.shape[1] - 2 + c]
+    dx = (win(dem, 0, 2) + 2 * win(dem, 1, 2) + win(dem, 2, 2)) - (win(dem, 0, 0) + 2 * win(dem, 1, 0) + win(dem, 2, 0))
+    dy = (win(dem, 2, 0) + 2 * win(dem, 2, 1) + win(dem, 2, 2)) - (win(dem, 0, 0) + 2 * win(dem, 0, 1) + win(dem, 0, 2))
+    masked = np.ones(dem.shape, dtype=bool)
+    masked[1:-1, 1:-1] = False
+    if invalid.any():
+        for r in range(3):
+            for c in range(3):
+                masked[1:-1, 1:-1] |= win(invalid, r, c)
+    return dx, dy, masked
+
+def horn_aspect(dem, nodata=None) -> np.ndarray:
+    """
+    horn_aspect computes aspect in degrees (azimuth, 0 is north) with Horn's method as gdaldem does
+
+    dem: 2d elevation array
+    nodata: optional nodata value of dem
+
+    Flat cells, cells on the array edge and cells next to nodata are -9999.
+    """
+    dx, dy, masked = horn_window(dem, nodata)
+    aspect = np.degrees(np.arctan2(dy, -dx))
+    aspect = np.where(aspect > 90, 450 - aspect, 90 - aspect)
+    aspect[aspect == 360] = 0
+    aspect[dx * dx + dy * dy <= 1.e-12] = -9999
+    result = np.full(masked.shape, -9999, dtype=np.float32)
+    result[1:-1, 1:-1] = aspect
+    result[masked] = -9999
+    return result
+
+def horn_slope(dem, xres, yres, nodata=None) -> np.ndarray:
+    """
+    horn_slope computes slope in degrees with Horn's method as gdaldem does
+
+    dem: 2d elevation array
+    xres, yres: cell size in the units of the elevations
+    nodata: optional nodata value of dem
+
+    Cells on the array edge and cells next to nodata are -9999.
+    """
+    dx, dy, masked = horn_window(dem, nodata)
+    result = np.full(masked.shape, -9999, dtype=np.float32)
+    result[1:-1, 1:-1] = np.degrees(np.arctan(np.hypot(dx / (8 * xres), dy / (8 * yres))))
+    result[masked] = -9999
+    return result
+
+def tile_windows(width, height, tile_size) -> list:
+    """
+    tile_windows splits a raster of width x height cells into tile_size square windows
+    """
+    return [Window(col, row, min(tile_size, width - col), min(tile_size, height - row))
+        for row in range(0, height, tile_size) for col in range(0, width, tile_size)]
+
+def pad_window(window, pad) -> Window:
+    """
+    pad_window returns window grown by pad cells on every side, the area read_tile reads with a halo of pad
+    before it is clipped to the raster
+    """
+    return Window(window.col_off - pad, window.row_off - pad, window.width + 2 * pad, window.height + 2 * pad)
+
+def imap_tiles(pool, fn, calls, max_workers=None):
+    """
+    imap_tiles yields fn(*args) for every args in calls in order, like pool.map, but only submits a call
+    as earlier results are consumed so at most twice max_workers calls (and their arguments) are pending.
+    calls may be a generator so the arguments of later tiles are only built when needed.
+    """
+    in_flight_max = 2 * (max_workers or os.cpu_count() or 1)
+    in_flight = deque()
+    try:
+        for args in calls:
+            if len(in_flight) >= in_flight_max:
+                yield in_flight.popleft().result()
+            in_flight.append(pool.submit(fn, *args))
+        while in_flight:
+            yield in_flight.popleft().result()
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+def sieve_cells(min_area, res) -> int:
+    """
+    sieve_cells returns the sieve size in cells of regions smaller than min_area (crs units squared)
+    on a raster of resolution res, 0 when there is no min_area
+    """
+    if not min_area:
+        return 0
+    return int(np.ceil(min_area / abs(res[0] * res[1])))
+
+def sieve_classes(classified, size) -> np.ndarray:
+    """
+    sieve_classes merges 4-connected regions of fewer than size cells into their largest neighbouring
+    region (rasterio.features.sieve), so small regions are absorbed instead of leaving holes
+    """
+    if size <= 1:
+        return classified
+    return sieve(classified, size, connectivity=4)
+
+def read_tile(rast_dem, window, halo=1) -> dict:
+    """
+    read_tile reads one window of rast_dem with halo cells around it
+
+    rast_dem: elevation raster path
+    window: rasterio Window of the tile
+    halo: cells read around the window so derived products (and sieving) are correct at the tile edges
+
+    returns a dict with the dem (including the halo), nodata, res, the window transform and bounds,
+    the transform and bounds of the dem including the halo (outer_transform, outer_bounds),
+    core (the slices of the window inside dem) and seams (tile edges shared with another tile)
+    """
+    with rasterio.open(rast_dem) as src:
+        col_off = max(window.col_off - halo, 0)
+        row_off = max(window.row_off - halo, 0)
+        outer = Window(col_off, row_off,
+            min(window.col_off + window.width + halo, src.width) - col_off,
+            min(window.row_off + window.height + halo, src.height) - row_off)
+        r = window.row_off - row_off
+        c = window.col_off - col_off
+        return {'dem': src.read(1, window=outer), 'nodata': src.nodata, 'res': src.res,
+            'transform': src.window_transform(window), 'bounds': src.window_bounds(window),
+            'outer_transform': src.window_transform(outer), 'outer_bounds': src.window_bounds(outer),
+            'core': (slice(r, r + window.height), slice(c, c + window.width)),
+            # as (left, top, right, bottom)
+            'seams': (window.col_off > 0, window.row_off > 0,
+                window.col_off + window.width < src.width, window.row_off + window.height < src.height)}
+
+def polygonize_tile(classified, tile) -> list:
+    """
+    polygonize_tile polygonizes the classified cells of a tile read with read_tile
+
+    returns a list of (polygon, class value, touches a neighbouring tile)
+    """
+    left, bottom, right, top = tile['bounds']
+    seams = tile['seams']
+    polygons = []
+    for poly, value in shapes(classified, transform=tile['transform']):
+        geometry = shape(poly)
+        minx, miny, maxx, maxy = geometry.bounds
+        on_seam = (seams[0] and minx <= left) or (seams[1] and maxy >= top) or \
+            (seams[2] and maxx >= right) or (seams[3] and miny <= bottom)
+        polygons.append((geometry, int(value), on_seam))
+    return polygons
+
+def process_tile(rast_dem, window, breaks, product='elevation', halo=1, sieve=0) -> list:
+    """
+    process_tile classifies and polygonizes one window of rast_dem, this runs in the worker processes
+
+    rast_dem: elevation raster path
+    window: rasterio Window of the tile
+    breaks: ClassBreaks of the product
+    product: 'elevation' classifies the DEM values, 'aspect' and 'slope' classify horn_aspect or horn_slope of the DEM
+    halo: cells read around the window so derived products are correct at the tile edges
+    sieve: sieve size in cells, see sieve_classes. As many cells again are read around the window so
+        regions crossing the tile edge are measured whole
+
+    returns a list of (polygon, class value, touches a neighbouring tile)
+    """
+    tile = read_tile(rast_dem, window, halo + sieve)
+    dem = tile['dem']
+    nodata = tile['nodata']
+    if product == 'aspect':
+        dem = horn_aspect(dem, nodata)
+        nodata = -9999
+    elif product == 'slope':
+        dem = horn_slope(dem, *tile['res'], nodata)
+        nodata = -9999
+    elif product != 'elevation':
+        raise ValueError(f"unknown product {product}")
+    classified = sieve_classes(breaks.classify(dem, nodata=nodata), sieve)[tile['core']]
+    return polygonize_tile(classified, tile)
+
+def process_snowpack_tile(rast_dem, window, zones, elevation_breaks, aspect_breaks, lut, halo=1, sieve=0) -> tuple:
+    """
+    process_snowpack_tile computes the snowpack class of every cell of one window in a single pass,
+    this runs in the worker processes
+
+    rast_dem: elevation raster path
+    window: rasterio Window of the tile
+    zones: list of (BEC polygon, zone code) intersecting the window
+    elevation_breaks, aspect_breaks: ClassBreaks of elevation and aspect
+    lut: array of snowpack class values indexed by [zone code, elevation class, aspect class]
+    halo: cells read around the window so aspect is correct at the tile edges
+    sieve: sieve size in cells, see process_tile
+
+    returns (list of (polygon, class value, touches a neighbouring tile), snowpack class array)
+    """
+    tile = read_tile(rast_dem, window, halo + sieve)
+    dem = tile['dem']
+    elevation = elevation_breaks.classify(dem, nodata=tile['nodata'])
+    aspect = aspect_breaks.classify(horn_aspect(dem, tile['nodata']), nodata=-9999)
+    if zones:
+        zone = rasterize(zones, out_shape=dem.shape, transform=tile['outer_transform'], fill=0, dtype='uint16')
+    else:
+        zone = np.zeros(dem.shape, dtype=np.uint16)
+    classified = sieve_classes(lut[zone, elevation, aspect], sieve)[tile['core']]
+    return polygonize_tile(classified, tile), classified
+
+class PolygonWriter:
+    """
+    PolygonWriter streams classified polygons to a GeoParquet, GeoPackage or Shapefile in chunks
+
+    output: output file, .parquet is written as GeoParquet with pyarrow, other extensions (.gpkg, .shp)
+        are appended chunk by chunk through geopandas
+    labels: class names indexed by class value, see ClassBreaks.labels
+    crs: crs of the polygons
+    dissolve: union the polygons of every class into one feature per class, written on close
+    chunk_size: polygons held in memory before a chunk is written
+
+    Class names are mapped for a whole chunk at once so nothing is applied row by row.
+
+    example usage with PolygonWriter("outputs/snowpack.parquet", breaks.labels, src.crs, dissolve=True) as writer:
+                      writer.write(shapes(classified, transform=src.transform))
+    """
+    def __init__(self, output, labels, crs=None, dissolve=False, chunk_size=100000) -> None:
+        self.output = output
+        self.labels = labels
+        self.crs = crs
+        self.dissolve = dissolve
+        self.chunk_size = chunk_size
+        self.geometries = []
+        self.values = []
+        self.dissolved = {}
+        self.parquet = None
+        self.count = 0
+        self.is_parquet = os.path.splitext(output)[1].lower() in ('.parquet', '.geoparquet')
+        self.dtype = np.uint8 if len(labels) < 256 else np.uint16
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def write(self, features) -> None:
+        """
+        write adds (polygon, class value) pairs, polygons may be GeoJSON like dicts as yielded
+        by rasterio.features.shapes or shapely geometries
+        """
+        for geometry, value in features:
+            self.geometries.append(geometry if isinstance(geometry, shapely.Geometry) else shape(geometry))
+            self.values.append(value)
+            if len(self.geometries) >= self.chunk_size:
+                self.flush()
+
+    def flush(self) -> None:
+        """
+        flush writes (or dissolves) the polygons held in memory
+        """
+        if not self.geometries:
+            return
+        geometries = np.array(self.geometries, dtype=object)
+        values = np.array(self.values, dtype=self.dtype)
+        self.geometries = []
+        self.values = []
+        if self.dissolve:
+            for value in np.unique(values):
+                # union every chunk down to one geometry so the parts held per class stay few
+                parts = self.dissolved.setdefault(int(value), [])
+                parts.append(shapely.union_all(geometries[values == value]))
+        else:
+            self.write_chunk(geometries, values)
+
+    def write_chunk(self, geometries, values) -> None:
+        if len(geometries) == 0:
+            return
+        names = self.labels[values].astype(str)
+        if self.is_parquet:
+            table = pyarrow.table({'geometry': pyarrow.array(shapely.to_wkb(geometries), type=pyarrow.binary()),
+                'class': pyarrow.array(values, type=pyarrow.from_numpy_dtype(self.dtype)),
+                'class_name': pyarrow.array(names, type=pyarrow.string())})
+            if self.parquet is None:
+                crs = CRS.from_user_input(self.crs).to_json_dict() if self.crs is not None else None
+                geo = {'version': '1.0.0', 'primary_column': 'geometry',
+                    'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': [], 'crs': crs}}}
+                schema = table.schema.with_metadata({b'geo': json.dumps(geo).encode('utf-8')})
+                self.parquet = pyarrow.parquet.ParquetWriter(self.output, schema, compression='zstd')
+            self.parquet.write_table(table.cast(self.parquet.schema))
+        else:
+            gdf = geopandas.GeoDataFrame({'class': values, 'class_name': names}, geometry=geometries, crs=self.crs)
+            gdf.to_file(self.output, mode='a' if self.count else 'w')
+        self.count += len(geometries)
+
+    def close(self) -> None:
+        """
+        close writes the remaining polygons (and the dissolved classes) and closes the output
+        """
+        self.flush()
+        if self.dissolve:
+            values = sorted(self.dissolved)
+            geometries = np.array([shapely.union_all(self.dissolved[value]) for value in values], dtype=object)
+            self.dissolved = {}
+            self.write_chunk(geometries, np.array(values, dtype=self.dtype))
+        if self.parquet is not None:
+            self.parquet.close()
+            self.parquet = None
+        logging.info(f"Wrote {self.count} polygons to {self.output}")
+
 class Snowpack:
     def __init__(self,bec,rast_dem) -> None:
         self.bec = bec
         self.dem = rast_dem
-    def classify(self) -> bool:
-        pass
+    def classify(self, output = None, output_raster = None, bec_field = 'MAP_LABEL',
+        elevation_classes = {'Low': (0,1000),'High': (1000,np.inf)},
+        aspect_classes = {'135 >= aspect =< 270':(135,271)}, snowpack_rules = None,
+        tile_size = 2048, halo = 1, max_workers = None, dissolve = False, min_area = None) -> str:
+        """
+        classify creates the 8-008 snowpack classification of the DEM from the BEC zone, elevation class
+        and aspect class of every cell.
+
+        output: (optional) output polygon file, default is None which will provide a GeoPackage in a temporary location
+        output_raster: (optional) GeoTIFF to write the snowpack class raster to
+        bec_field: field of the BEC layer (self.bec, a file or GeoDataFrame) holding the zone label
+        elevation_classes, aspect_classes: dictionaries of class name:(low break point, high breakpoints)
+        snowpack_rules: (optional) dictionary of snowpack class name:[(zone, elevation class, aspect class), ...]
+            where '*' matches anything and the first matching class wins, e.g.
+            {'Deep': [('ESSFwc4', '*', '*'), ('ICHmw2', 'High', '*')], 'Shallow': [('*', 'Low', '135 >= aspect =< 270')]}
+            Cells matching no rule are 'None'. Default is None which makes every zone / elevation / aspect
+            combination its own class.
+        tile_size, halo, max_workers: tiling of the DEM, see classify_tiled
+        dissolve: (optional) write one feature per class, see PolygonWriter
+        min_area: (optional) merge regions smaller than this area (crs units squared) into their
+            neighbours before polygonizing, see sieve_classes
+
+        Each tile is read once, the BEC zones (clipped to the tile) are rasterized onto it and the elevation
+        class, aspect class and zone of every cell are combined through one lookup table, so no intermediate
+        layers are written or overlaid. Tiles are submitted as results are written, see imap_tiles.
+
+        returns output file path as str
+
+        example usage sp = Snowpack("inputs/bec.gpkg", "inputs/mydem.tif")
+                      sp.classify(output="outputs/snowpack.gpkg", output_raster="outputs/snowpack.tif", snowpack_rules=rules)
+        """
+        logging.info("Starting snowpack classification")
+        if output is None:
+            output = self.temp_path('snowpack.gpkg')
+        assert os.path.exists(self.dem)
+        elevation_breaks = ClassBreaks(elevation_classes)
+        aspect_breaks = ClassBreaks(aspect_classes)
+        with rasterio.open(self.dem) as src:
+            windows = tile_windows(src.width, src.height, tile_size)
+            crs = src.crs
+            profile = self.classified_profile(src)
+            transform = src.transform
+            size = sieve_cells(min_area, src.res)
+
+        bec = self.bec if isinstance(self.bec, geopandas.GeoDataFrame) else geopandas.read_file(self.bec, columns=[bec_field])
+        if crs is not None and bec.crs is not None and bec.crs != crs:
+            bec = bec.to_crs(crs)
+        zone_names = ['None'] + sorted(bec[bec_field].dropna().astype(str).unique())
+        codes = bec[bec_field].astype(str).map({name: code for code, name in enumerate(zone_names)}).fillna(0).to_numpy()
+        labels, lut = self.snowpack_table(zone_names, elevation_breaks.labels, aspect_breaks.labels, snowpack_rules)
+
+        def calls():
+            for window in windows:
+                # the zones are clipped to the area the tile reads so only that part is sent to the worker
+                bounds = window_bounds(pad_window(window, halo + size), transform)
+                hits = bec.sindex.query(shapely.box(*bounds))
+                clipped = shapely.clip_by_rect(bec.geometry.values[hits], *bounds)
+                zones = [(geometry, int(codes[i])) for i, geometry in zip(hits, clipped) if not geometry.is_empty]
+                yield self.dem, window, zones, elevation_breaks, aspect_breaks, lut, halo, size
+
+        logging.info(f"Processing {len(windows)} tiles")
+        profile.update(dtype=lut.dtype.name)
+        dst = rasterio.open(output_raster, 'w', **profile) if output_raster is not None else None
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                def tiles():
+                    results = imap_tiles(pool, process_snowpack_tile, calls(), max_workers)
+                    for window, (polygons, classified) in zip(windows, results):
+                        if dst is not None:
+                            dst.write(classified, 1, window=window)
+                        yield polygons
+                self.write_tiles(tiles(), output, labels, crs, dissolve=dissolve)
+        finally:
+            if dst is not None:
+                dst.close()
+        return output
+    def snowpack_table(self, zone_names, elevation_labels, aspect_labels, snowpack_rules=None) -> tuple:
+        """
+        snowpack_table builds the snowpack class lookup indexed by [zone code, elevation class, aspect class]
+
+        returns (class names indexed by class value, lookup array)
+        """
+        dims = (len(zone_names), len(elevation_labels), len(aspect_labels))
+        if snowpack_rules is None:
+            labels = np.array([f"{z} / {e} / {a}" for z in zone_names for e in elevation_labels for a in aspect_labels], dtype=object)
+            lut = np.arange(len(labels)).reshape(dims)
+        else:
+            labels = np.array(['None'] + list(snowpack_rules.keys()), dtype=object)
+            lut = np.zeros(dims, dtype=np.int64)
+            axes = [np.array(zone_names, dtype=object), np.array(elevation_labels, dtype=object), np.array(aspect_labels, dtype=object)]
+            for value, rules in enumerate(snowpack_rules.values(), 1):
+                for rule in rules:
+                    masks = [np.ones(len(axis), dtype=bool) if key == '*' else axis == key for axis, key in zip(axes, rule)]
+                    for axis, key, mask in zip(axes, rule, masks):
+                        if not mask.any():
+                            logging.warning(f"snowpack rule {rule} of {labels[value]}: {key} is not a known class")
+                    matched = masks[0][:, None, None] & masks[1][None, :, None] & masks[2][None, None, :]
+                    lut[matched & (lut == 0)] = value
+        dtype = np.uint8 if len(labels) < 256 else np.uint16
+        return labels, lut.astype(dtype)
+    def write_tiles(self, tiles, output, labels, crs, dissolve=False) -> str:
+        """
+        write_tiles writes the polygons of processed tiles to output, polygons touching a tile seam are
+        dissolved with their neighbours of the same class before they are written
+
+        tiles: iterable of polygon lists as returned by process_tile
+        """
+        seam = []
+        with PolygonWriter(output, labels, crs, dissolve=dissolve) as writer:
+            for polygons in tiles:
+                # polygons inside a tile are final and written as soon as the tile is done
+                writer.write((geometry, value) for geometry, value, on_seam in polygons if not on_seam)
+                seam.extend((geometry, value) for geometry, value, on_seam in polygons if on_seam)
+
+            logging.info(f"Stitching {len(seam)} polygons on tile seams")
+            for value in sorted({value for _, value in seam}):
+                merged = shapely.union_all([geometry for geometry, v in seam if v == value])
+                writer.write((geometry, value) for geometry in shapely.get_parts(merged))
+        return output
     def generate_aspect(self,rast_dem, output = None,class_dict = {'135 >= aspect =< 270':(135,271)}) -> None:
         """
         generate_aspect creates a polygon shapefile containing the aspect classes provided
 
         rast_dem: elevation raster format readable by gdal / rasterio
-        output: optional shapefile
+        output: optional shapefile, default is None which will provide a file in a new temporary directory
         class_dict: dictionary of aspect breaks with format {name:(low break point, high breakpoints)}
 
+        Aspect is computed from the DEM in memory (horn_aspect) tile by tile and classified directly,
+        no aspect raster is written.
+
         returns output
 
         example usage sp.generate_aspect(rast_dem = "inputs/mydem.tif",output= "outputs/aspect.shp,class_dict ={'90 to 270':(90:270)})
 
 
         """
-        output_shp = os.path.join(tempfile.gettempdir(),'aspect.shp')
-        output_rast = os.path.join(tempfile.gettempdir(),'aspect.tif')
-        options = gdal.DEMProcessingOptions(creationOptions= ['COMPRESS=LZW',])
-        gdal.DEMProcessing(output_rast,rast_dem,processing='aspect',options=options)
-        result = self.classify_elevation(rast_dem=output_rast,output=output_shp,
-            elevation_classes={'135 >= aspect =< 270':(135,271)})
-        os.remove(output_rast)
-        return result
+        return self.classify_tiled(rast_dem, output=output, classes=class_dict, product='aspect')
+    def generate_slope(self,rast_dem, output = None,class_dict = {'< 30':(0,30),'>= 30':(30,91)}) -> str:
+        """
+        generate_slope creates a polygon shapefile containing the slope classes (degrees) provided
+
+        rast_dem: elevation raster format readable by rasterio
+        output: optional shapefile, default is None which will provide a file in a new temporary directory
+        class_dict: dictionary of slope breaks with format {name:(low break point, high breakpoints)}
+
+        returns output
+
+        example usage sp.generate_slope(rast_dem = "inputs/mydem.tif",class_dict ={'steep':(30,91)})
+        """
+        return self.classify_tiled(rast_dem, output=output, classes=class_dict, product='slope')
+    def temp_path(self, name) -> str:
+        """
+        temp_path returns name inside a new temporary directory so concurrent runs never share intermediates
+        """
+        return os.path.join(tempfile.mkdtemp(prefix='snowpack_'), name)
+    def classified_profile(self, src) -> dict:
+        """
+        classified_profile returns the creation profile for a uint8 class raster matching src
+
+        src: open rasterio dataset
+
+        The block layout of src is kept so every source block window is written to whole output blocks.
+        """
+        profile = src.profile.copy()
+        profile.update(driver='GTiff', dtype='uint8', count=1, nodata=None, compress='lzw')
+        blocky, blockx = src.block_shapes[0]
+        if blockx < src.width and blockx % 16 == 0 and blocky % 16 == 0:
+            profile.update(tiled=True, blockxsize=blockx, blockysize=blocky)
+        else:
+            profile.update(tiled=False, blockysize=blocky)
+            profile.pop('blockxsize', None)
+        return profile
     def classify_elevation(self, rast_dem, output = None,
-        elevation_classes={'Low': (0,1000),'High': (1000,np.inf)}) -> str:
+        elevation_classes={'Low': (0,1000),'High': (1000,np.inf)}, dissolve=False, min_area=None) -> str:
         """
         Classify_elevation creates a polygon geometry shapefile containing the elevation classes provided.
 
         rast_dem: The input elevation raster
-        output: (optional) output shapefile name, default is None which will provide a file in a temporary location
+        output: (optional) output shapefile name, default is None which will provide a file in a temporary location.
+            A .parquet (GeoParquet) or .gpkg output avoids the 2 GB shapefile limit on large DEMs.
         elevation_classes: this is a dictionary of elevation class name:(low break point, high breakpoints)
-            default is {'Low': (0,1000),'High': (1000,np.inf)} .
+            default is {'Low': (0,1000),'High': (1000,np.inf)} . Breaks may not overlap, see ClassBreaks.
+        dissolve: (optional) write one feature per class
+        min_area: (optional) merge regions smaller than this area (crs units squared) into their
+            neighbours before polygonizing, see sieve_classes. Sieving needs the classes around every
+            region, so these runs are handed to classify_tiled which sieves each tile with a margin.
         
         returns output file path as str
 
+        The DEM is read and classified one block window at a time and the classified raster is
+        written tile by tile, so peak memory depends on the raster block size rather than the DEM size.
+
         TODO: implement COG reading or WCS? https://automating-gis-processes.github.io/CSC/notebooks/L5/read-cogs.html
         """
         logging.info("Starting to classify elevation")
         if output is None:
-            output = os.path.join(tempfile.gettempdir(),'classified_dem.shp')
-        outputdem = os.path.join(tempfile.gettempdir(),'classified_dem.tif')
+            output = self.temp_path('classified_dem.shp')
         assert os.path.exists(rast_dem)    
-        with rasterio.open(rast_dem) as src:
-            logging.debug(f"Reading raster: {rast_dem}")
-            dem = src.read(1)
-            classified_dem = np.zeros_like(dem, dtype=np.uint8)
-            for label, (min_elevation, max_elevation) in elevation_classes.items():
-                logging.debug("Classify {label} --> min: {min_elevation}, max:{max_elevation}")
-                classified_dem[(dem >= min_elevation) & (dem < max_elevation)] = list(elevation_classes.keys()).index(label) + 1
-
-        logging.info("Polygonizing raster")    
-        polygons = list(shapes(classified_dem, transform=src.transform))
-        polygon_features = [(shape(poly), value) for poly, value in polygons]
-        gdf = geopandas.GeoDataFrame(polygon_features, columns=['geometry', 'class'])
-        # chnage to human labels
-        def get_class(x):
-            v = int(x)
-            if v > 0:
-                return list(elevation_classes.keys())[v-1]
-            else:
-                return 'None'
-        gdf['class_name'] = gdf['class'].apply(get_class)
-        gdf.to_file(output)
+        if min_area:
+            return self.classify_tiled(rast_dem, output, classes=elevation_classes, dissolve=dissolve, min_area=min_area)
+        breaks = ClassBreaks(elevation_classes)
+        outputdem = self.temp_path('classified_dem.tif')
+        try:
+            with rasterio.open(rast_dem) as src:
+                logging.debug(f"Reading raster: {rast_dem}")
+                with rasterio.open(outputdem, 'w', **self.classified_profile(src)) as dst:
+                    for _, window in src.block_windows(1):
+                        dem = src.read(1, window=window)
+                        dst.write(breaks.classify(dem, nodata=src.nodata), 1, window=window)
+
+            logging.info("Polygonizing raster")    
+            # GDAL polygonizes straight from the band, reading the classified raster a few lines at a time,
+            # and the polygons are written in chunks as they are produced
+            with rasterio.open(outputdem) as classified:
+                with PolygonWriter(output, breaks.labels, classified.crs, dissolve=dissolve) as writer:
+                    writer.write(shapes(rasterio.band(classified, 1)))
+        finally:
+            shutil.rmtree(os.path.dirname(outputdem), ignore_errors=True)
         return output
+    def classify_tiled(self, rast_dem, output = None, classes={'Low': (0,1000),'High': (1000,np.inf)},
+        product='elevation', tile_size=2048, halo=1, max_workers=None, dissolve=False, min_area=None) -> str:
+        """
+        classify_tiled creates the same polygon classes as classify_elevation (or aspect and slope classes
+        with product='aspect' or 'slope') by processing tiles of the DEM across a process pool.
+
+        rast_dem: The input elevation raster
+        output: (optional) output file name, default is None which will provide a file in a temporary location
+        classes: dictionary of class name:(low break point, high breakpoints) of the product
+        product: 'elevation', 'aspect' or 'slope'
+        tile_size: tile width and height in cells
+        halo: cells of overlap read around every tile so aspect is correct on tile edges
+        max_workers: number of processes, default is the number of cores
+        dissolve: (optional) write one feature per class, see PolygonWriter
+        min_area: (optional) merge regions smaller than this area (crs units squared) into their
+            neighbours before polygonizing, see sieve_classes
+
+        Each tile is read with its halo, classified and polygonized in a worker. Polygons that reach a
+        tile seam are dissolved with their neighbours of the same class so the stitched result matches
+        an untiled run.
+
+        returns output file path as str
+
+        example usage sp.classify_tiled("inputs/mydem.tif", product='aspect', classes={'135 to 270':(135,271)})
+        """
+        logging.info(f"Starting to classify {product} in tiles")
+        if output is None:
+            output = self.temp_path(f'classified_{product}.shp')
+        assert os.path.exists(rast_dem)
+        breaks = ClassBreaks(classes)
+        with rasterio.open(rast_dem) as src:
+            windows = tile_windows(src.width, src.height, tile_size)
+            crs = src.crs
+            size = sieve_cells(min_area, src.res)
+        logging.info(f"Processing {len(windows)} tiles")
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            tiles = imap_tiles(pool, process_tile,
+                ((rast_dem, window, breaks, product, halo, size) for window in windows), max_workers)
+            return self.write_tiles(tiles, output, breaks.labels, crs, dissolve=dissolve)
 
    
 
@@ -3,48 +3,206 @@ import json
 import tempfile
 import logging
 import requests
+import requests.adapters
+import urllib3.util
 import geojson
 import geopandas
 import duckdb
 import psutil
+import shapely
+import pyarrow
+import pyarrow.parquet
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from shapely.geometry import shape
-from arcgis.gis import GIS
-from arcgis.features import FeatureSet
-from arcgis.geometry import Geometry
-from arcgis.geometry.filters import intersects
+from shapely.geometry.polygon import orient
 
 
 logger = logging.getLogger(__name__)
 
+class FeatureServiceError(Exception):
+    '''Raised when a feature service returns an error'''
+
+
 class ArcGIS_downloader:
     '''
     Downloads data from ArcGIS Online
+
+    Layers are paged by objectId ranges over a thread pool and every page is
+    appended to a GeoParquet file as it arrives, so only max_workers pages are
+    held in memory. item_id may be an ArcGIS Online item or a feature layer url
+    (e.g. a local stand-in service .../FeatureServer/0).
     '''
-    def __init__(self,url="https://www.arcgis.com",username=None,password=None) -> None:
+    PAGESIZE = 2000      # capped by the layer maxRecordCount
+    MAX_WORKERS = 4
+    TIMEOUT = 120
+    MAX_RETRIES = 5
+    # esri field types as arrow types, dates arrive as epoch milliseconds
+    FIELD_TYPES = {'esriFieldTypeOID': pyarrow.int64(),
+                   'esriFieldTypeInteger': pyarrow.int64(),
+                   'esriFieldTypeSmallInteger': pyarrow.int32(),
+                   'esriFieldTypeBigInteger': pyarrow.int64(),
+                   'esriFieldTypeDouble': pyarrow.float64(),
+                   'esriFieldTypeSingle': pyarrow.float32(),
+                   'esriFieldTypeDate': pyarrow.timestamp('ms')}
+
+    def __init__(self,url="https://www.arcgis.com",username=None,password=None,cache_dir=None) -> None:
+        self.CACHE_DIR = cache_dir or tempfile.gettempdir()
+        self.session = requests.Session()
+        retry = urllib3.util.Retry(total=self.MAX_RETRIES, backoff_factor=0.5,
+                                   status_forcelist=[429, 500, 502, 503, 504], allowed_methods=False)
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.MAX_WORKERS * 2, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         try:
+            # arcgis is only needed to look up item ids, feature layer urls work without it
+            from arcgis.gis import GIS
             self.mh = GIS(url,username,password)
             logging.debug(f'Connected to ArcGIS Online as user: {self.mh.user.username}')
         except:
+            self.mh = None
             logging.debug('Failed to connect to ArcGIS Online')
         pass
-    def download(self, item_id,query_str = "1=1", filter_geojson=None) -> str:
-        output = os.path.join(self.CACHE_DIR,'download.geojson')
+
+    def download(self, item_id,query_str = "1=1", filter_geojson=None, output=None, max_workers=None) -> str:
+        ''' Downloads the first layer of an item to GeoParquet (EPSG:4326)
+        params:
+            item_id: ArcGIS Online item id or feature layer url
+            query_str: sql where clause
+            filter_geojson: area of interest, a GeoJSON file or GeoJSON dict, features
+                intersecting it are downloaded
+            output: output .parquet path, defaults to CACHE_DIR/download.parquet. Pages are
+                written to output.part which replaces output once every page is written
+            max_workers: pages requested at once
+        returns: output path
+        usage:
+            agol = ArcGIS_downloader()
+            agol.download('<item id>', "FEATURE_CLASS = 'A'", filter_geojson='boundary_tsa_4326.geojson')
+        '''
+        if output is None:
+            output = os.path.join(self.CACHE_DIR,'download.parquet')
+        max_workers = max_workers or self.MAX_WORKERS
+        layer_url = self.layer_url(item_id)
+        layer = self.feature_query(layer_url, {'f': 'json'})
+        oid_field = layer.get('objectIdField', 'OBJECTID')
+        pagesize = min(self.PAGESIZE, layer.get('maxRecordCount') or self.PAGESIZE)
+        params = {'where': query_str, 'f': 'geojson', 'outFields': '*', 'outSR': 4326, 'returnGeometry': 'true'}
+        if filter_geojson is not None:
+            params.update(self.__filter_params__(filter_geojson))
+
+        ids = self.feature_query(f'{layer_url}/query', dict(params, returnIdsOnly='true', f='json'))
+        oids = sorted(ids.get('objectIds') or [])
+        logging.info(f'Downloading {len(oids)} features in pages of {pagesize}')
+        schema = self.__schema__(layer.get('fields', []))
+        pages = [(oids[i], oids[min(i + pagesize, len(oids)) - 1]) for i in range(0, len(oids), pagesize)]
+        written = 0
+        part = f'{output}.part'
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            writer = pyarrow.parquet.ParquetWriter(part, schema, compression='zstd')
+            try:
+                # pages are written in objectId order, at most max_workers pages are waiting
+                in_flight = deque()
+                for low, high in pages:
+                    if len(in_flight) >= max_workers:
+                        written += self.__write_page__(writer, schema, in_flight.popleft().result())
+                    where = f'{oid_field} >= {low} AND {oid_field} <= {high} AND ({query_str})'
+                    in_flight.append(executor.submit(self.feature_query, f'{layer_url}/query',
+                                                     dict(params, where=where)))
+                while in_flight:
+                    written += self.__write_page__(writer, schema, in_flight.popleft().result())
+                    logging.debug(f'{written} of {len(oids)} features written')
+            except BaseException:
+                for future in in_flight:
+                    future.cancel()
+                writer.close()
+                os.remove(part)
+                raise
+            writer.close()
+        os.replace(part, output)
+        logging.info(f'Wrote {written} features to {output}')
+        return output
+
+    def layer_url(self, item_id) -> str:
+        '''Returns the url of the first layer of an item, urls are returned as is'''
+        if item_id.startswith(('http://', 'https://')):
+            return item_id.rstrip('/')
+        if self.mh is None:
+            raise FeatureServiceError(f'Not connected to ArcGIS Online, cannot look up item {item_id}')
         dl_item = self.mh.content.get(item_id)
-        dl_layer = dl_item.layers[0]
-        if filter_geojson:
-            with open(r'W:\srm\nel\Local\Geomatics\Workarea\wburt\p2023\015_hlpo_tool_upgrade\boundary_tsa_4326.geojson') as f:
+        return dl_item.layers[0].url
+
+    def feature_query(self, url, params) -> dict:
+        '''POSTs a feature service request, returns the decoded json'''
+        token = getattr(getattr(self.mh, '_con', None), 'token', None)
+        if token:
+            params = dict(params, token=token)
+        r = self.session.post(url, data=params, timeout=self.TIMEOUT)
+        logging.debug(f'Feature service request: {url} in {r.elapsed.total_seconds():.3f}s')
+        r.raise_for_status()
+        result = r.json()
+        # errors are reported with a 200 status
+        if 'error' in result:
+            raise FeatureServiceError(f"Feature service request failed: {result['error']}")
+        return result
+
+    def __filter_params__(self, filter_geojson) -> dict:
+        '''Returns intersects query params for a GeoJSON file or dict'''
+        if isinstance(filter_geojson, dict):
+            filter_json = filter_geojson
+        else:
+            with open(filter_geojson) as f:
                 filter_json = json.load(f)
-                filter = FeatureSet.from_geojson(filter_json)
-            filter_geom = filter.features[0].geometry
-            filter_sr = filter.spatial_reference
-            filter_fun = intersects(filter_geom,filter_sr)
+        if filter_json.get('type') == 'FeatureCollection':
+            geoms = [shape(feat['geometry']) for feat in filter_json['features']]
+        elif filter_json.get('type') == 'Feature':
+            geoms = [shape(filter_json['geometry'])]
         else:
-            filter_fun = None   
-        feat_set = dl_layer.query(where = query_str,geometry_filter=filter_fun)
-        with open(output,'w',encoding="utf-8") as f:
-            f.write(feat_set.to_geojson)
-        return
+            geoms = [shape(filter_json)]
+        aoi = shapely.union_all(geoms)
+        # esri rings run clockwise, holes counterclockwise
+        polygons = getattr(aoi, 'geoms', [aoi])
+        rings = []
+        for polygon in polygons:
+            polygon = orient(polygon, sign=-1.0)
+            rings.append([list(c) for c in polygon.exterior.coords])
+            rings += [[list(c) for c in interior.coords] for interior in polygon.interiors]
+        return {'geometry': json.dumps({'rings': rings, 'spatialReference': {'wkid': 4326}}),
+                'geometryType': 'esriGeometryPolygon',
+                'spatialRel': 'esriSpatialRelIntersects',
+                'inSR': 4326}
+
+    def __schema__(self, fields) -> pyarrow.Schema:
+        '''Returns the GeoParquet schema of the layer fields'''
+        columns = [pyarrow.field(f['name'], self.FIELD_TYPES.get(f['type'], pyarrow.string()))
+                   for f in fields if f['type'] not in ('esriFieldTypeGeometry', 'esriFieldTypeBlob',
+                                                        'esriFieldTypeRaster')]
+        columns.append(pyarrow.field('geometry', pyarrow.binary()))
+        geo = {'version': '1.0.0', 'primary_column': 'geometry',
+               'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': []}}}
+        return pyarrow.schema(columns, metadata={b'geo': json.dumps(geo).encode('utf-8')})
+
+    def __write_page__(self, writer, schema, page) -> int:
+        '''Appends a GeoJSON page to the parquet writer, returns the feature count'''
+        features = page.get('features', [])
+        if not features:
+            return 0
+        columns = {}
+        for field in schema:
+            if field.name == 'geometry':
+                continue
+            values = [feat['properties'].get(field.name) for feat in features]
+            if pyarrow.types.is_timestamp(field.type):
+                columns[field.name] = pyarrow.array(values, pyarrow.int64()).cast(field.type)
+            elif pyarrow.types.is_string(field.type):
+                columns[field.name] = pyarrow.array([None if v is None else str(v) for v in values],
+                                                    field.type)
+            else:
+                columns[field.name] = pyarrow.array(values, field.type)
+        geoms = [shape(feat['geometry']) if feat.get('geometry') else None for feat in features]
+        columns['geometry'] = pyarrow.array(shapely.to_wkb(geoms), pyarrow.binary())
+        writer.write_table(pyarrow.Table.from_pydict(columns, schema=schema))
+        return len(features)
     
  
 class WFS_downloader:
@@ -89,8 +247,10 @@ class WFS_downloader:
         sql = f"CREATE TABLE IF NOT EXISTS wfs_data AS \
             SELECT * EXCLUDE {self.data_geom_column}, ST_GeomFromWKB({self.data_geom_column}) as {self.data_geom_column} FROM '{self.CACHE_DIR}/*.parquet'"
         self.con.sql(sql)
-        df = self.con.sql(f'SELECT * EXCLUDE {self.data_geom_column},ST_AsText({self.data_geom_column}) as {self.data_geom_column}  FROM wfs_data').to_df()
-        df[self.data_geom_column] = geopandas.GeoSeries.from_wkt(df[self.data_geom_column])
+        df = self.con.sql(f'SELECT * EXCLUDE {self.data_geom_column},ST_AsWKB({self.data_geom_column}) as {self.data_geom_column}  FROM wfs_data').to_df()
+        # NULL geometries come back as None, the rest as bytearray
+        wkb = df[self.data_geom_column].map(lambda b: None if b is None else bytes(b))
+        df[self.data_geom_column] = geopandas.GeoSeries.from_wkb(wkb)
         gdf = geopandas.GeoDataFrame(df,geometry=self.data_geom_column,crs=self.data_crs)
         return gdf
     def get_data(self, dataset,query=None, fields=None,bbox=None):
@@ -0,0 +1,343 @@
+'''
+Benchmarks for the WFS downloader and the snowpack raster classification.
+
+WFS downloads run against a local stand-in for the openmaps GeoServer WFS that serves
+synthetic VRI like polygons with startIndex/count paging, numberMatched, resultType=hits,
+gzip, injected 502 responses and added latency. Raster cases classify generated DEMs.
+Every case runs in a fresh process so peak RSS is that of the case alone (tile worker
+processes of classify_tiled are not included).
+
+usage:
+    python benchmark.py
+    python benchmark.py --features 50000 --pagesizes 2000 10000 --workers 1 4 --latency 0.2 --error-rate 0.05
+    python benchmark.py --skip-raster --json results.json
+'''
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+SPECIES = ['FD', 'PL', 'LW', 'SX', 'CW', 'HW', 'BL', 'PY', 'AT', 'EP']
+
+
+def vri_feature(i) -> dict:
+    '''Returns a synthetic VEG_COMP_LYR_R1_POLY like feature, a 16 vertex polygon on a 200 m grid'''
+    rng = random.Random(i)
+    x = 1500000 + (i % 500) * 200
+    y = 500000 + (i // 500) * 200
+    ring = [[round(x + 100 + 90 * rng.uniform(0.6, 1.0) * dx, 3), round(y + 100 + 90 * rng.uniform(0.6, 1.0) * dy, 3)]
+            for dx, dy in [(1, 0), (0.9, 0.4), (0.7, 0.7), (0.4, 0.9), (0, 1), (-0.4, 0.9), (-0.7, 0.7), (-0.9, 0.4),
+                           (-1, 0), (-0.9, -0.4), (-0.7, -0.7), (-0.4, -0.9), (0, -1), (0.4, -0.9), (0.7, -0.7), (0.9, -0.4)]]
+    ring.append(ring[0])
+    properties = {'OBJECTID': i + 1, 'FEATURE_ID': 10000000 + i, 'MAP_ID': f'082F{i % 100:03d}',
+                  'POLYGON_ID': 20000000 + i, 'BCLCS_LEVEL_1': 'V', 'BCLCS_LEVEL_2': 'T', 'BCLCS_LEVEL_3': 'U',
+                  'BCLCS_LEVEL_4': rng.choice(['TC', 'TM', 'TB']), 'BCLCS_LEVEL_5': rng.choice(['DE', 'OP', 'SP']),
+                  'PROJ_AGE_1': rng.randint(1, 350), 'PROJ_HEIGHT_1': round(rng.uniform(1, 45), 1),
+                  'CROWN_CLOSURE': rng.randint(0, 100), 'SITE_INDEX': round(rng.uniform(5, 30), 1),
+                  'LIVE_STAND_VOLUME_125': round(rng.uniform(0, 900), 2), 'POLYGON_AREA': round(rng.uniform(1, 40), 4),
+                  'HARVEST_DATE': None if rng.random() < 0.8 else f'{rng.randint(1960, 2022)}-01-01Z',
+                  'PROJECTED_DATE': '2023-01-01Z', 'LINE_7B_DISTURBANCE_HISTORY': None,
+                  'FOR_MGMT_LAND_BASE_IND': rng.choice(['Y', 'N'])}
+    for n in range(1, 4):
+        properties[f'SPECIES_CD_{n}'] = rng.choice(SPECIES)
+        properties[f'SPECIES_PCT_{n}'] = round(rng.uniform(0, 100), 1)
+    return {'type': 'Feature', 'id': f'VEG_COMP_LYR_R1_POLY.{i + 1}', 'geometry_name': 'GEOMETRY',
+            'geometry': {'type': 'Polygon', 'coordinates': [ring]}, 'properties': properties}
+
+
+class StubWFSHandler(BaseHTTPRequestHandler):
+    ''' GeoServer compatible GetFeature responses for the synthetic features'''
+    protocol_version = 'HTTP/1.1'
+    features = []    #features pre-serialized as json strings
+    latency = 0.0
+    error_rate = 0.0
+    use_gzip = True
+    max_count = None    #page size cap, like a GeoServer maxFeatures limit
+    requests_served = None
+    bytes_sent = None
+    errors_injected = None
+    features_served = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.respond({k.lower(): v[0] for k, v in parse_qs(urlparse(self.path).query).items()})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        self.respond({k.lower(): v[0] for k, v in parse_qs(body).items()})
+
+    def send_body(self, body, content_type):
+        if self.use_gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, compresslevel=1)
+            encoding = 'gzip'
+        else:
+            encoding = None
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.bytes_sent.get_lock():
+            self.bytes_sent.value += len(body)
+
+    def respond(self, q):
+        with self.requests_served.get_lock():
+            self.requests_served.value += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            with self.errors_injected.get_lock():
+                self.errors_injected.value += 1
+            self.send_response(502, 'Bad Gateway')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        matched = len(self.features)
+        if q.get('resulttype') == 'hits':
+            self.send_body(f'<wfs:FeatureCollection numberMatched="{matched}" numberReturned="0" '
+                           f'timeStamp="2023-10-17T17:51:53.757Z"/>'.encode(), 'text/xml')
+            return
+        start = int(q.get('startindex', 0))
+        count = int(q.get('count', q.get('limit', 10000)))
+        if self.max_count:
+            count = min(count, self.max_count)
+        page = self.features[start:start + count]
+        with self.features_served.get_lock():
+            self.features_served.value += len(page)
+        body = ('{"type":"FeatureCollection","features":[' + ','.join(page) + '],'
+                f'"totalFeatures":{matched},"numberMatched":{matched},"numberReturned":{len(page)},'
+                '"timeStamp":"2023-10-17T17:51:53.757Z",'
+                '"crs":{"type":"name","properties":{"name":"urn:ogc:def:crs:EPSG::3005"}}}').encode()
+        self.send_body(body, 'application/json;charset=UTF-8')
+
+
+def serve(features, latency, error_rate, use_gzip, port, counters, ready, max_count=None):
+    '''Runs the stand-in WFS until the process is terminated'''
+    StubWFSHandler.features = [json.dumps(vri_feature(i), separators=(',', ':')) for i in range(features)]
+    StubWFSHandler.latency = latency
+    StubWFSHandler.error_rate = error_rate
+    StubWFSHandler.use_gzip = use_gzip
+    StubWFSHandler.max_count = max_count
+    (StubWFSHandler.requests_served, StubWFSHandler.bytes_sent, StubWFSHandler.errors_injected,
+     StubWFSHandler.features_served) = counters
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubWFSHandler)
+    server.daemon_threads = True
+    port.value = server.server_port
+    ready.set()
+    server.serve_forever()
+
+
+class StubWFS:
+    ''' Starts the stand-in WFS in its own process so it does not count towards client RSS
+    usage:
+        with StubWFS(features=20000, latency=0.1) as wfs:
+            downloader.SERVICE_URL = wfs.url
+    '''
+    def __init__(self, features=20000, latency=0.0, error_rate=0.0, use_gzip=True, max_count=None) -> None:
+        ctx = multiprocessing.get_context('spawn')
+        self.port = ctx.Value('i', 0)
+        self.counters = (ctx.Value('q', 0), ctx.Value('q', 0), ctx.Value('q', 0), ctx.Value('q', 0))
+        self.ready = ctx.Event()
+        self.process = ctx.Process(target=serve, daemon=True,
+                                   args=(features, latency, error_rate, use_gzip, self.port, self.counters, self.ready,
+                                         max_count))
+
+    def __enter__(self):
+        self.process.start()
+        if not self.ready.wait(300):
+            raise RuntimeError('stub WFS did not start')
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.join()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.port.value}/geo/pub/ows?'
+
+    def stats(self) -> dict:
+        return {'requests': self.counters[0].value, 'bytes': self.counters[1].value,
+                'errors_injected': self.counters[2].value, 'features_served': self.counters[3].value}
+
+    def reset(self) -> None:
+        for counter in self.counters:
+            counter.value = 0
+
+
+def peak_rss() -> int:
+    '''Returns the peak resident set size of this process in bytes'''
+    try:
+        import resource
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+
+
+def run_wfs_case(url, pagesize, max_workers, spill, result, backoff) -> dict:
+    '''Downloads the stub dataset once with get_data, runs in a fresh process'''
+    import datatools
+    wfs = datatools.WFS_downloader()
+    wfs.SERVICE_URL = url
+    wfs.PAGESIZE = pagesize
+    wfs.BACKOFF = backoff
+    spills = []
+    write = datatools.SpillCache.write
+
+    def counting_write(cache, df):
+        spills.append(len(df))
+        return write(cache, df)
+    datatools.SpillCache.write = counting_write
+    if spill == 'forced':
+        # spill every page without changing the page size the memory budget picks
+        wfs.memory.spill_rows = lambda: 1
+    start_rss = peak_rss()
+    start = time.perf_counter()
+    data = wfs.get_data('WHSE_FOREST_VEGETATION.VEG_COMP_LYR_R1_POLY', max_workers=max_workers, result=result)
+    seconds = time.perf_counter() - start
+    return {'features': data.num_rows if result == 'arrow' else len(data), 'seconds': seconds,
+            'peak_rss': peak_rss(), 'rss_growth': peak_rss() - start_rss, 'spills': len(spills)}
+
+
+def run_raster_case(size, method, tile_size, max_workers) -> dict:
+    '''Classifies a generated size x size DEM, runs in a fresh process'''
+    import tempfile
+    import numpy as np
+    import rasterio
+    from rasterio.transform import from_origin
+    import shutil
+    workdir = tempfile.mkdtemp(prefix='benchmark_')
+    # snow-pack.py is not an importable module name, the tile workers import this copy
+    shutil.copy(os.path.join(SRC, 'snow-pack.py'), os.path.join(workdir, 'snowpack.py'))
+    sys.path.insert(0, workdir)
+    import snowpack
+
+    dem_path = os.path.join(workdir, 'dem.tif')
+    y, x = np.mgrid[0:size, 0:size].astype('float32')
+    dem = 400 + 1800 * (np.sin(x / size * 6) * np.cos(y / size * 5) + 1) / 2 + 30 * np.sin(x / 9) * np.cos(y / 7)
+    with rasterio.open(dem_path, 'w', driver='GTiff', width=size, height=size, count=1, dtype='float32',
+                       crs='EPSG:3005', transform=from_origin(1500000, 600000, 25, 25), nodata=-9999,
+                       tiled=True, blockxsize=256, blockysize=256, compress='lzw') as dst:
+        dst.write(dem.astype('float32'), 1)
+    del y, x, dem
+    sp = snowpack.Snowpack(None, dem_path)
+    output = os.path.join(workdir, 'classes.parquet')
+    classes = {'Low': (0, 1000), 'Mid': (1000, 1600), 'High': (1600, np.inf)}
+    start_rss = peak_rss()
+    start = time.perf_counter()
+    if method == 'classify_elevation':
+        sp.classify_elevation(dem_path, output=output, elevation_classes=classes)
+    elif method == 'aspect':
+        sp.classify_tiled(dem_path, output=output, product='aspect', tile_size=tile_size, max_workers=max_workers,
+                          classes={'NE': (0, 90), 'SE': (90, 180), 'SW': (180, 270), 'NW': (270, 361)})
+    else:
+        sp.classify_tiled(dem_path, output=output, classes=classes, tile_size=tile_size, max_workers=max_workers)
+    seconds = time.perf_counter() - start
+    import pyarrow.parquet
+    polygons = pyarrow.parquet.read_metadata(output).num_rows
+    shutil.rmtree(workdir, ignore_errors=True)
+    return {'cells': size * size, 'polygons': polygons, 'seconds': seconds, 'peak_rss': peak_rss(),
+            'rss_growth': peak_rss() - start_rss}
+
+
+def in_fresh_process(fn, *args) -> dict:
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(fn, *args).result()
+
+
+def wfs_benchmarks(args) -> list:
+    results = []
+    with StubWFS(args.features, args.latency, args.error_rate, not args.no_gzip) as stub:
+        for pagesize in args.pagesizes:
+            for max_workers in args.workers:
+                for spill in args.spill:
+                    stub.reset()
+                    case = {'benchmark': 'get_data', 'pagesize': pagesize, 'max_workers': max_workers,
+                            'spill': spill, 'result': args.result, 'latency': args.latency,
+                            'error_rate': args.error_rate}
+                    case.update(in_fresh_process(run_wfs_case, stub.url, pagesize, max_workers, spill,
+                                                 args.result, args.backoff))
+                    case.update(stub.stats())
+                    # a case that lost or repeated pages is not a valid measurement
+                    assert case['features'] == case['features_served'] == args.features, \
+                        f"fetched {case['features']} of {args.features} features, the stub served {case['features_served']}"
+                    case['features_per_sec'] = case['features'] / case['seconds']
+                    case['mb_per_sec'] = case['bytes'] / case['seconds'] / 1e6
+                    results.append(case)
+                    print(f"get_data pagesize={pagesize:>6} workers={max_workers:>2} spill={spill:<7} "
+                          f"{case['features']:>8} features {case['seconds']:7.2f}s {case['features_per_sec']:9.0f} f/s "
+                          f"{case['bytes'] / 1e6:8.1f} MB {case['requests']:>5} requests "
+                          f"{case['errors_injected']:>3} 502s peak RSS {case['peak_rss'] / 1e6:7.0f} MB "
+                          f"spills {case['spills']}")
+    return results
+
+
+def raster_benchmarks(args) -> list:
+    results = []
+    for size in args.raster_sizes:
+        for method in args.raster_methods:
+            case = {'benchmark': method, 'size': size, 'tile_size': args.tile_size, 'max_workers': args.raster_workers}
+            try:
+                case.update(in_fresh_process(run_raster_case, size, method, args.tile_size, args.raster_workers))
+            except ImportError as e:
+                print(f"{method} skipped, snow-pack.py dependencies are missing: {e}")
+                return results
+            case['cells_per_sec'] = case['cells'] / case['seconds']
+            results.append(case)
+            print(f"{method:<18} {size:>6}x{size:<6} {case['seconds']:7.2f}s {case['cells_per_sec'] / 1e6:7.1f} Mcells/s "
+                  f"{case['polygons']:>8} polygons peak RSS {case['peak_rss'] / 1e6:7.0f} MB")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--features', type=int, default=20000, help='features served by the stub WFS')
+    parser.add_argument('--pagesizes', type=int, nargs='+', default=[2000, 10000])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4], help='get_data max_workers values')
+    parser.add_argument('--spill', nargs='+', default=['budget', 'forced'], choices=['budget', 'forced'],
+                        help="'budget' uses the default memory budget, 'forced' spills every page")
+    parser.add_argument('--result', default='geopandas', choices=['geopandas', 'arrow'])
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every WFS response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of WFS requests answered with 502')
+    parser.add_argument('--backoff', type=float, default=0.05, help='WFS_downloader.BACKOFF for the runs')
+    parser.add_argument('--no-gzip', action='store_true', help='send uncompressed responses')
+    parser.add_argument('--raster-sizes', type=int, nargs='+', default=[2048, 4096], help='DEM edge lengths in cells')
+    parser.add_argument('--raster-methods', nargs='+', default=['classify_elevation', 'classify_tiled', 'aspect'],
+                        choices=['classify_elevation', 'classify_tiled', 'aspect'])
+    parser.add_argument('--tile-size', type=int, default=1024)
+    parser.add_argument('--raster-workers', type=int, default=None)
+    parser.add_argument('--skip-wfs', action='store_true')
+    parser.add_argument('--skip-raster', action='store_true')
+    parser.add_argument('--json', help='write the results to this json file')
+    args = parser.parse_args()
+
+    results = []
+    if not args.skip_wfs:
+        results += wfs_benchmarks(args)
+    if not args.skip_raster:
+        results += raster_benchmarks(args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+                       'cpus': os.cpu_count(), 'results': results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
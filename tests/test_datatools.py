@@ -0,0 +1,367 @@
+'''
+Tests for datatools against the stand-in WFS from benchmark.py
+
+usage:
+    python -m pytest tests
+'''
+import os
+import sys
+import json
+import asyncio
+
+import pytest
+import pandas
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchmark import SRC, StubWFS
+sys.path.insert(0, SRC)
+import datatools
+
+DATASET = 'WHSE_FOREST_VEGETATION.VEG_COMP_LYR_R1_POLY'
+
+
+@pytest.fixture(scope='module')
+def capped_wfs():
+    '''A WFS that returns at most 1000 features per page'''
+    with StubWFS(features=5000, max_count=1000, use_gzip=False) as stub:
+        yield stub
+
+
+def downloader(url, pagesize) -> datatools.WFS_downloader:
+    wfs = datatools.WFS_downloader()
+    wfs.SERVICE_URL = url
+    wfs.PAGESIZE = pagesize
+    return wfs
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_capped_page_size(capped_wfs, max_workers):
+    df = downloader(capped_wfs.url, 2000).get_data(DATASET, max_workers=max_workers)
+    assert len(df) == 5000
+    assert df['OBJECTID'].tolist() == list(range(1, 5001))
+
+
+def test_async_overlapping_calls(capped_wfs):
+    wfs = datatools.AsyncWFS_downloader(max_in_flight=4)
+    wfs.SERVICE_URL = capped_wfs.url
+    wfs.PAGESIZE = 2000
+
+    async def overlapping():
+        return await asyncio.gather(wfs.fetch_many([DATASET, DATASET]), wfs.get_data_async(DATASET))
+
+    (first, second), third = asyncio.run(overlapping())
+    for df in (first, second, third):
+        assert df['OBJECTID'].tolist() == list(range(1, 5001))
+        assert df.crs == 'EPSG:3005'
+
+
+@pytest.mark.parametrize('tile_size, tiles', [(0, 1), (None, 3)])
+def test_aoi_tile_size(capped_wfs, tile_size, tiles):
+    # the stand-in ignores filters, every tile downloads all 5 pages of the layer
+    aoi = datatools.shapely.box(1500000, 500000, 1560000, 502000)
+    capped_wfs.reset()
+    df = downloader(capped_wfs.url, 1000).get_data(DATASET, aoi=aoi, tile_size=tile_size)
+    assert capped_wfs.stats()['requests'] == tiles * 5
+    assert len(df) == df['OBJECTID'].nunique() == int(df.geometry.intersects(aoi).sum())
+    assert len(df) > 0
+
+
+def test_page_metrics(capped_wfs):
+    wfs = downloader(capped_wfs.url, 1000)
+    wfs.session.headers['Accept-Encoding'] = 'identity'
+    events = []
+    wfs.metrics.add_hook(events.append)
+    wfs.get_data(DATASET)
+    pages = [e for e in events if e['event'] == 'page']
+    assert sum(p['features'] for p in pages) == 5000
+    # uncompressed responses arrive as sent
+    assert all(p['wire_bytes'] == p['bytes'] and p['latency'] > 0 for p in pages)
+    assert wfs.metrics.summary()['wire_bytes_unknown'] == 0
+
+
+def test_memory_budget_first_page(capped_wfs):
+    wfs = datatools.WFS_downloader(memory_budget=1)
+    wfs.SERVICE_URL = capped_wfs.url
+    events = []
+    wfs.metrics.add_hook(events.append)
+    df = wfs.get_data(DATASET)
+    pages = [e['features'] for e in events if e['event'] == 'page']
+    assert pages[0] == wfs.memory.min_pagesize
+    assert len(df) == 5000
+    assert wfs.memory.bytes_per_feature is not None
+
+
+def test_arrow_spill_cache_lifetime(capped_wfs):
+    wfs = downloader(capped_wfs.url, 1000)
+    wfs.memory.spill_rows = lambda: 1
+    table = wfs.get_data(DATASET, result='arrow')
+    assert table.num_rows == 5000
+    with datatools.SpillCache(format='arrow') as cache:
+        table = wfs.get_data(DATASET, result='arrow', spill_cache=cache)
+        sliced = table.slice(4000)
+        assert len(cache.files) == 5
+        assert wfs.arrow_to_df(sliced)['OBJECTID'].tolist() == list(range(4001, 5001))
+    del table, sliced
+    assert not os.path.exists(cache.path)
+
+
+def test_retries_at_least_once(capped_wfs):
+    wfs = downloader(capped_wfs.url, 1000)
+    wfs.MAX_RETRIES = 0
+    assert len(wfs.get_data(DATASET)) == 5000
+    # nothing listens on the discard port
+    wfs.SERVICE_URL = 'http://127.0.0.1:9/geoserver/ows'
+    with pytest.raises(datatools.WFSError, match='after 1 attempts: WFS request failed'):
+        wfs.wfs_query(DATASET, count=10)
+
+
+def test_register_parquet_quoting(capped_wfs, tmp_path):
+    wfs = downloader(capped_wfs.url, 1000)
+    wfs.CACHE_DIR = str(tmp_path / "o'brien")
+    os.makedirs(wfs.CACHE_DIR)
+    first = wfs.download_to_duckdb(DATASET, 'vri "r1"', max_workers=1)
+    second = wfs.download_to_duckdb(DATASET, 'vri "r1"', max_workers=1)
+    assert first == second == 'vri "r1"'
+    assert len(os.listdir(wfs.CACHE_DIR)) == 2
+    assert wfs.sql('SELECT count(*) FROM "vri ""r1"""').fetchone()[0] == 5000
+
+
+def test_fast_decode_matches_features_to_df(capped_wfs):
+    pytest.importorskip('pyogrio')
+    features = [{'type': 'Feature', 'id': f'LAYER.{i}',
+                 'geometry': None if i == 2 else {'type': 'Point', 'coordinates': [1200000 + i, 500000]},
+                 'properties': {'OBJECTID': i, 'NAME': None if i == 1 else f'n{i}', 'EMPTY': None,
+                                'AREA': i * 0.5, 'BIG': 2 ** 40 + i, 'FLAG': True,
+                                'DATE': f'2023-01-0{i + 1}Z', 'COUNT': None if i == 0 else i}}
+                for i in range(3)]
+    content = json.dumps({'type': 'FeatureCollection', 'features': features,
+                          'numberMatched': 3, 'numberReturned': 3}).encode()
+    slow = downloader(capped_wfs.url, 1000)
+    fast = downloader(capped_wfs.url, 1000)
+    fast.FAST_DECODE = True
+    pandas.testing.assert_frame_equal(fast.page_to_df(fast.decode_page(content), 'EPSG:3005'),
+                                      slow.page_to_df(slow.decode_page(content), 'EPSG:3005'))
+    pandas.testing.assert_frame_equal(fast.get_data(DATASET), slow.get_data(DATASET))
+
+
+def test_sync_unchanged_nullable_column(capped_wfs, tmp_path):
+    # the stand-in ignores filters, the date pass returns every feature
+    wfs = downloader(capped_wfs.url, 1000)
+    path = str(tmp_path / 'vri.parquet')
+    assert wfs.sync(DATASET, path)['added'] == 5000
+    stored = datatools.geopandas.read_parquet(path)
+    stored['CROWN_CLOSURE'] = stored['CROWN_CLOSURE'].astype('float64')
+    stored.loc[0, 'CROWN_CLOSURE'] = None
+    stored = stored[stored['OBJECTID'] != 5000]
+    stored.to_parquet(path)
+    stats = wfs.sync(DATASET, path, date_field='PROJECTED_DATE')
+    assert stats == {'added': 1, 'updated': 1, 'deleted': 0, 'unchanged': 4998}
+    synced = datatools.geopandas.read_parquet(path)
+    assert synced['OBJECTID'].tolist() == list(range(1, 5001))
+    assert synced['CROWN_CLOSURE'].notna().all()
+    assert wfs.sync(DATASET, path, date_field='PROJECTED_DATE')['unchanged'] == 5000
+
+
+def test_sync_without_date_field(capped_wfs, tmp_path):
+    wfs = downloader(capped_wfs.url, 1000)
+    path = str(tmp_path / 'vri.parquet')
+    wfs.download_to_parquet(DATASET, path)
+    stored = datatools.geopandas.read_parquet(path)
+    stored[stored['OBJECTID'] > 2].to_parquet(path)
+    stats = wfs.sync(DATASET, path)
+    assert stats['added'] == 2 and stats['deleted'] == 0
+    synced = datatools.geopandas.read_parquet(path)
+    assert synced['OBJECTID'].tolist() == list(range(1, 5001))
+
+
+def test_progress_per_call(capped_wfs):
+    wfs = downloader(capped_wfs.url, 1000)
+    events = []
+    wfs.metrics.add_hook(events.append)
+    for _ in range(2):
+        events.clear()
+        wfs.get_data(DATASET)
+        pages = [e for e in events if e['event'] == 'page']
+        assert [p['returned'] for p in pages] == [1000, 2000, 3000, 4000, 5000]
+        assert all(p['matched'] == 5000 for p in pages)
+        assert [e['event'] for e in events if e['event'] != 'page'] == ['start', 'finish']
+    # AOI tiles add up to one progress
+    events.clear()
+    aoi = datatools.shapely.box(1500000, 500000, 1560000, 502000)
+    wfs.get_data(DATASET, aoi=aoi)
+    pages = [e for e in events if e['event'] == 'page']
+    assert pages[-1]['returned'] == pages[-1]['matched'] == 15000
+    assert [e['event'] for e in events if e['event'] != 'page'] == ['start', 'finish']
+
+
+def test_failed_download_to_parquet_keeps_path(capped_wfs, tmp_path):
+    wfs = downloader(capped_wfs.url, 1000)
+    wfs.MAX_RETRIES = 1
+    path = str(tmp_path / 'vri.parquet')
+    fetch = wfs.wfs_query
+
+    def failing_query(dataset, start_index=None, **kwargs):
+        if start_index == 3000:
+            raise datatools.WFSError('WFS request failed after 1 attempts: 502 Bad Gateway')
+        return fetch(dataset, start_index=start_index, **kwargs)
+    wfs.wfs_query = failing_query
+    with pytest.raises(datatools.WFSError):
+        wfs.download_to_parquet(DATASET, path, max_workers=1)
+    assert os.listdir(tmp_path) == []
+    wfs.wfs_query = fetch
+    wfs.download_to_parquet(DATASET, path)
+    assert os.listdir(tmp_path) == ['vri.parquet']
+    assert datatools.pyarrow.parquet.ParquetFile(path).metadata.num_rows == 5000
+
+
+def cached_get(wfs, stub, **kwargs):
+    '''Returns (rows, WFS requests made) of a get_data call'''
+    stub.reset()
+    df = wfs.get_data(DATASET, **kwargs)
+    return len(df), stub.stats()['requests']
+
+
+def test_dataset_cache_hit_and_refresh(capped_wfs, tmp_path):
+    wfs = datatools.WFS_downloader(dataset_cache=datatools.DatasetCache(str(tmp_path)))
+    wfs.SERVICE_URL = capped_wfs.url
+    wfs.PAGESIZE = 1000
+    assert cached_get(wfs, capped_wfs) == (5000, 5)
+    assert cached_get(wfs, capped_wfs) == (5000, 0)
+    assert cached_get(wfs, capped_wfs, refresh=True) == (5000, 5)
+    # a different query is a different entry
+    assert cached_get(wfs, capped_wfs, query="BCLCS_LEVEL_1 = 'V'") == (5000, 5)
+    assert len([f for f in os.listdir(tmp_path) if f.endswith('.parquet')]) == 2
+
+
+def test_dataset_cache_ttl(capped_wfs, tmp_path):
+    cache = datatools.DatasetCache(str(tmp_path), ttl=3600)
+    wfs = datatools.WFS_downloader(dataset_cache=cache)
+    wfs.SERVICE_URL = capped_wfs.url
+    wfs.PAGESIZE = 1000
+    assert cached_get(wfs, capped_wfs) == (5000, 5)
+    assert cached_get(wfs, capped_wfs) == (5000, 0)
+    cache.ttl = 0
+    assert cached_get(wfs, capped_wfs) == (5000, 5)
+
+
+def test_dataset_cache_lru_eviction(capped_wfs, tmp_path):
+    cache = datatools.DatasetCache(str(tmp_path))
+    wfs = datatools.WFS_downloader(dataset_cache=cache)
+    wfs.SERVICE_URL = capped_wfs.url
+    wfs.PAGESIZE = 1000
+    queries = ["MAP_ID = 'a'", "MAP_ID = 'b'", "MAP_ID = 'c'"]
+    keys = [cache.key(cache.params(capped_wfs.url, DATASET, query=query)) for query in queries]
+    for query in queries[:2]:
+        cached_get(wfs, capped_wfs, query=query)
+    cache.max_bytes = int(os.path.getsize(cache.data_path(keys[0])) * 2.5)
+    # a hit makes a the most recently used, b is evicted for c
+    assert cached_get(wfs, capped_wfs, query=queries[0]) == (5000, 0)
+    cached_get(wfs, capped_wfs, query=queries[2])
+    assert [os.path.exists(cache.data_path(key)) for key in keys] == [True, False, True]
+    # an entry larger than max_bytes is kept until the next one is stored
+    cache.max_bytes = 1
+    path = cache.put(cache.key({'query': 'large'}), wfs.get_data(DATASET))
+    assert os.path.exists(path)
+    assert [f for f in os.listdir(tmp_path) if f.endswith('.parquet')] == [os.path.basename(path)]
+
+
+def test_retry_bad_gateway():
+    with StubWFS(features=5000, max_count=1000, error_rate=0.5, use_gzip=False) as stub:
+        wfs = downloader(stub.url, 250)
+        wfs.BACKOFF = 0
+        wfs.MAX_RETRIES = 20
+        events = []
+        wfs.metrics.add_hook(events.append)
+        df = wfs.get_data(DATASET, max_workers=4)
+        stats = stub.stats()
+    assert df['OBJECTID'].tolist() == list(range(1, 5001))
+    assert stats['errors_injected'] > 0
+    assert stats['requests'] == 20 + stats['errors_injected']
+    assert len([e for e in events if e['event'] == 'retry']) == stats['errors_injected']
+
+
+def test_retry_truncated_body(capped_wfs):
+    wfs = downloader(capped_wfs.url, 1000)
+    wfs.BACKOFF = 0
+    get = wfs.session.get
+    truncated = []
+
+    def truncating_get(url, params=None, **kwargs):
+        r = get(url, params=params, **kwargs)
+        if params.get('startIndex') == 2000 and not truncated:
+            truncated.append(params['startIndex'])
+            r._content = r.content[:len(r.content) // 2]
+        return r
+    wfs.session.get = truncating_get
+    capped_wfs.reset()
+    df = wfs.get_data(DATASET)
+    assert truncated == [2000]
+    assert df['OBJECTID'].tolist() == list(range(1, 5001))
+    assert capped_wfs.stats()['requests'] == 6
+
+
+def test_resume_skips_checkpointed_pages(capped_wfs, tmp_path):
+    wfs = downloader(capped_wfs.url, 1000)
+    wfs.CACHE_DIR = str(tmp_path)
+    fetch = wfs.wfs_query
+
+    def failing_query(dataset, start_index=None, **kwargs):
+        if start_index == 3000:
+            raise datatools.WFSError('WFS request failed after 5 attempts: 502 Bad Gateway')
+        return fetch(dataset, start_index=start_index, **kwargs)
+    wfs.wfs_query = failing_query
+    with pytest.raises(datatools.WFSError):
+        wfs.get_data(DATASET, resume=True)
+    assert len(os.listdir(tmp_path)) == 1
+    wfs.wfs_query = fetch
+    capped_wfs.reset()
+    df = wfs.get_data(DATASET, resume=True)
+    # only the pages from the failed one on are requested again
+    assert capped_wfs.stats()['requests'] == 2
+    assert df['OBJECTID'].tolist() == list(range(1, 5001))
+    assert os.listdir(tmp_path) == []
+
+
+class OfflineDuckDB:
+    '''Stands in for the duckdb module, records extension installs and never loads spatial'''
+    Error = RuntimeError
+
+    def __init__(self):
+        self.installed = []
+
+    def connect(self, database, config):
+        duck = self
+
+        class Connection:
+            def load_extension(self, name):
+                if name not in duck.installed:
+                    raise duck.Error(f'{name} is not installed')
+
+            def install_extension(self, name):
+                duck.installed.append(name)
+
+            def cursor(self):
+                return self
+        return Connection()
+
+
+@pytest.mark.parametrize('install, default, installed', [
+    (None, False, []), (True, False, ['spatial']), (None, True, ['spatial']), (False, True, [])])
+def test_duckdb_extension_install_opt_in(monkeypatch, install, default, installed):
+    duck = OfflineDuckDB()
+    monkeypatch.setattr(datatools, 'duckdb', duck)
+    monkeypatch.setattr(datatools, '__duckdb_connection__', None)
+    monkeypatch.setattr(datatools, 'DUCKDB_INSTALL_EXTENSIONS', default)
+    datatools.duckdb_connection(install=install)
+    assert duck.installed == installed
+
+
+def test_duckdb_extension_dir_ignored_warning(monkeypatch, caplog):
+    monkeypatch.setattr(datatools, 'duckdb', OfflineDuckDB())
+    monkeypatch.setattr(datatools, '__duckdb_connection__', None)
+    datatools.duckdb_connection('/opt/duckdb/extensions')
+    caplog.clear()
+    datatools.duckdb_connection('/opt/duckdb/extensions')
+    assert 'is ignored' not in caplog.text
+    datatools.duckdb_connection('/srv/duckdb/extensions')
+    assert '/srv/duckdb/extensions is ignored' in caplog.text
@@ -0,0 +1,126 @@
+'''
+Tests for the snow-pack classifiers on a small synthetic DEM
+
+usage:
+    python -m pytest tests
+'''
+import os
+import sys
+import importlib.util
+
+import numpy as np
+import pytest
+import rasterio
+import shapely
+import geopandas
+from rasterio.transform import from_origin
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+# snow-pack is not an importable name, register it so process pool workers can unpickle its functions
+spec = importlib.util.spec_from_file_location('snowpack', os.path.join(SRC, 'snow-pack.py'))
+snowpack = importlib.util.module_from_spec(spec)
+sys.modules['snowpack'] = snowpack
+spec.loader.exec_module(snowpack)
+
+def test_class_breaks_values_on_breaks():
+    breaks = snowpack.ClassBreaks({'Low': (0, 1000), 'High': (1000, np.inf)})
+    values = np.array([-1, 0, 999.999, 1000, 5000, np.inf])
+    # low breaks are inclusive, high breaks exclusive
+    np.testing.assert_array_equal(breaks.classify(values), [0, 1, 1, 2, 2, 0])
+    assert breaks.classify(values).dtype == np.uint8
+    assert list(breaks.labels) == ['None', 'Low', 'High']
+
+
+def test_class_breaks_nodata():
+    values = np.array([[-9999, 500], [np.nan, 1500]], dtype='float32')
+    np.testing.assert_array_equal(snowpack.ClassBreaks({'Low': (-10000, 1000), 'High': (1000, 2000)},
+        nodata=-9999).classify(values), [[0, 1], [0, 2]])
+    # a nodata value passed to classify overrides the one given to ClassBreaks
+    breaks = snowpack.ClassBreaks({'Low': (0, 1000), 'High': (1000, 2000)}, nodata=-9999)
+    np.testing.assert_array_equal(breaks.classify(values, nodata=500), [[0, 0], [0, 2]])
+
+
+def test_class_breaks_gaps_and_order():
+    # classes keep their dictionary order as values whatever the order of the breaks
+    breaks = snowpack.ClassBreaks({'High': (1500, 3000), 'Low': (0, 1000)})
+    assert breaks.gaps == [(1000, 1500)]
+    np.testing.assert_array_equal(breaks.classify(np.array([100, 1200, 2000])), [2, 0, 1])
+
+
+@pytest.mark.parametrize('classes', [
+    {'Low': (0, 1000), 'High': (999, 2000)},
+    {'Low': (0, 1000), 'Inside': (200, 300)},
+    {'Empty': (10, 10)},
+    {},
+])
+def test_class_breaks_invalid(classes):
+    with pytest.raises(ValueError):
+        snowpack.ClassBreaks(classes)
+
+
+RES = 10
+WIDTH, HEIGHT = 160, 120
+MIN_AREA = 8 * RES * RES
+
+
+@pytest.fixture(scope='module')
+def noisy_dem(tmp_path_factory):
+    '''A DEM rising from 900 to 1100 west to east with noise that leaves many small islands'''
+    path = str(tmp_path_factory.mktemp('dem') / 'dem.tif')
+    rng = np.random.default_rng(0)
+    dem = np.linspace(900, 1100, WIDTH)[np.newaxis, :] + rng.normal(0, 40, (HEIGHT, WIDTH))
+    profile = dict(driver='GTiff', width=WIDTH, height=HEIGHT, count=1, dtype='float32',
+        crs='EPSG:3005', transform=from_origin(1000000, 500000, RES, RES), nodata=-9999)
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(dem.astype('float32'), 1)
+    return path
+
+
+def polygons(noisy_dem, tmp_path, method, **kwargs):
+    sp = snowpack.Snowpack('testbec', noisy_dem)
+    output = getattr(sp, method)(noisy_dem, output=str(tmp_path / 'classes.parquet'), **kwargs)
+    return geopandas.read_parquet(output)
+
+
+@pytest.mark.parametrize('method, kwargs', [
+    ('classify_elevation', {}),
+    ('classify_tiled', {'tile_size': 50, 'max_workers': 2}),
+])
+def test_min_area_sieve(noisy_dem, tmp_path, method, kwargs):
+    unsieved = polygons(noisy_dem, tmp_path, method, **kwargs)
+    sieved = polygons(noisy_dem, tmp_path, method, min_area=MIN_AREA, **kwargs)
+    # small regions are merged into their neighbours, the classes still cover the whole DEM
+    assert unsieved.area.min() < MIN_AREA
+    assert sieved.area.min() >= MIN_AREA
+    assert len(sieved) < len(unsieved)
+    assert sieved.area.sum() == pytest.approx(WIDTH * HEIGHT * RES * RES)
+    assert sieved.union_all().area == pytest.approx(WIDTH * HEIGHT * RES * RES)
+
+
+def test_classify_tiles_match_one_tile(noisy_dem, tmp_path):
+    # zones reaching well outside the DEM, split across tile seams
+    bec = geopandas.GeoDataFrame({'MAP_LABEL': ['ESSFwc4', 'ICHmw2']}, geometry=[
+        shapely.box(990000, 490000, 1000830, 510000), shapely.box(1000830, 490000, 1010000, 510000)],
+        crs='EPSG:3005')
+    sp = snowpack.Snowpack(bec, noisy_dem)
+    rasters = []
+    for tile_size in (WIDTH, 32):
+        output_raster = str(tmp_path / f'snowpack_{tile_size}.tif')
+        sp.classify(output=str(tmp_path / f'snowpack_{tile_size}.parquet'), output_raster=output_raster,
+            tile_size=tile_size, max_workers=2)
+        with rasterio.open(output_raster) as src:
+            rasters.append(src.read(1))
+    np.testing.assert_array_equal(rasters[0], rasters[1])
+    # columns west of the zone boundary only hold ESSFwc4 classes
+    assert len(np.unique(rasters[1][:, :83])) == len(np.unique(rasters[1][:, 83:])) == 4
+    assert not set(np.unique(rasters[1][:, :83])) & set(np.unique(rasters[1][:, 83:]))
+    polygons = geopandas.read_parquet(str(tmp_path / 'snowpack_32.parquet'))
+    assert polygons.area.sum() == pytest.approx(WIDTH * HEIGHT * RES * RES)
+
+
+def test_classify_elevation_failure_removes_temp_dir(noisy_dem, tmp_path, monkeypatch):
+    monkeypatch.setattr(snowpack.tempfile, 'tempdir', str(tmp_path))
+    sp = snowpack.Snowpack('testbec', noisy_dem)
+    with pytest.raises(Exception):
+        sp.classify_elevation(noisy_dem, output=str(tmp_path / 'missing' / 'classes.parquet'))
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,123 @@
+'''
+Tests for the ArcGIS feature layer download against a local stand-in service
+
+usage:
+    python -m pytest tests
+'''
+import os
+import re
+import sys
+import json
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import shapely
+import geopandas
+from shapely.geometry import Point, Polygon, LinearRing, shape
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'u4001')
+sys.path.insert(0, SRC)
+import vridownload
+
+# objectIds with gaps, as left by deleted features
+IDS = [i for i in range(1, 3001) if i % 7]
+FEATURES = {i: {'type': 'Feature',
+                'properties': {'OBJECTID': i, 'NAME': None if i % 11 == 0 else f'n{i}', 'CODE': i % 3},
+                'geometry': {'type': 'Point', 'coordinates': [-120 + (i % 100) * 0.01, 50 + (i // 100) * 0.01]}}
+            for i in IDS}
+LAYER = {'objectIdField': 'OBJECTID', 'maxRecordCount': 700, 'fields': [
+    {'name': 'OBJECTID', 'type': 'esriFieldTypeOID'},
+    {'name': 'NAME', 'type': 'esriFieldTypeString'},
+    {'name': 'CODE', 'type': 'esriFieldTypeSmallInteger'},
+    {'name': 'Shape', 'type': 'esriFieldTypeGeometry'}]}
+
+
+class StubFeatureLayerHandler(BaseHTTPRequestHandler):
+    '''
+    Answers layer and query requests like an ArcGIS feature layer. Only the where clauses
+    sent by ArcGIS_downloader are understood, anything else returns an esri error.
+    '''
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        query = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+        if not self.path.endswith('/query'):
+            return self.send(LAYER)
+        ids = IDS
+        where = query['where']
+        page = re.match(r'OBJECTID >= (\d+) AND OBJECTID <= (\d+) AND \((.*)\)', where)
+        if page:
+            ids = [i for i in ids if int(page[1]) <= i <= int(page[2])]
+            where = page[3]
+        if where == 'CODE = 1':
+            ids = [i for i in ids if i % 3 == 1]
+        elif where == 'FAIL_AFTER = 1000':
+            # the ids are found but pages past objectId 1000 fail
+            if page and int(page[1]) > 1000:
+                return self.send({'error': {'code': 500, 'message': 'Error performing query operation'}})
+        elif where != '1=1':
+            return self.send({'error': {'code': 400, 'message': 'Unable to complete operation.'}})
+        if 'geometry' in query:
+            # esri rings: clockwise shells, counter-clockwise holes
+            rings = json.loads(query['geometry'])['rings']
+            shells = [Polygon(r) for r in rings if not LinearRing(r).is_ccw]
+            holes = [Polygon(r) for r in rings if LinearRing(r).is_ccw]
+            aoi = shapely.union_all(shells).difference(shapely.union_all(holes))
+            ids = [i for i in ids if aoi.intersects(Point(FEATURES[i]['geometry']['coordinates']))]
+        if query.get('returnIdsOnly') == 'true':
+            return self.send({'objectIdFieldName': 'OBJECTID', 'objectIds': ids[::-1]})
+        if len(ids) > LAYER['maxRecordCount']:
+            return self.send({'error': {'code': 400, 'message': 'maxRecordCount exceeded'}})
+        self.send({'type': 'FeatureCollection', 'features': [FEATURES[i] for i in ids]})
+
+    def send(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture(scope='module')
+def layer_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubFeatureLayerHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/arcgis/rest/services/stub/FeatureServer/0'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def agol(tmp_path):
+    return vridownload.ArcGIS_downloader(cache_dir=str(tmp_path))
+
+
+def test_download_all_pages(agol, layer_url):
+    df = geopandas.read_parquet(agol.download(layer_url))
+    assert df['OBJECTID'].tolist() == IDS
+    # GeoParquet without a crs is longitude, latitude WGS 84
+    assert df.crs == 'OGC:CRS84'
+    assert df['NAME'].isna().sum() == len([i for i in IDS if i % 11 == 0])
+    assert str(df['CODE'].dtype) == 'int32'
+
+
+def test_download_query_and_aoi(agol, layer_url, tmp_path):
+    aoi = {'type': 'Polygon', 'coordinates': [
+        [[-120.005, 49.995], [-119.5, 49.995], [-119.5, 50.3], [-120.005, 50.3], [-120.005, 49.995]],
+        [[-119.9, 50.1], [-119.8, 50.1], [-119.8, 50.2], [-119.9, 50.2], [-119.9, 50.1]]]}
+    output = agol.download(layer_url, 'CODE = 1', filter_geojson=aoi, output=str(tmp_path / 'aoi.parquet'))
+    expected = [i for i in IDS if i % 3 == 1 and shape(aoi).intersects(shape(FEATURES[i]['geometry']))]
+    assert geopandas.read_parquet(output)['OBJECTID'].tolist() == expected
+
+
+def test_failed_download_leaves_no_output(agol, layer_url, tmp_path):
+    output = tmp_path / 'failed.parquet'
+    with pytest.raises(vridownload.FeatureServiceError):
+        agol.download(layer_url, 'FAIL_AFTER = 1000', output=str(output), max_workers=1)
+    assert os.listdir(tmp_path) == []